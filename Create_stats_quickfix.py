@@ -1,173 +1,993 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-from bs4 import BeautifulSoup
+# bs4, emoji and plotly are slow to import, they are imported where they are used
+# so stats-only runs and batch workers never load the plotting stack
+from lxml import etree
 import json
 import time
 import datetime
-import emoji as emoji_module
 import re
-import pdb
-import seaborn
-import matplotlib.pyplot as plt
-import plotly
-import plotly.plotly as pltly
-import plotly.graph_objs as go
-import warnings
 import logging
-logging.basicConfig(filename='logger.log',level=logging.DEBUG)
+import argparse
+import glob
+import os
+import collections
+import heapq
+import operator
+import functools
+import hashlib
+import shutil
+import contextlib
+import gc
+import logging.handlers
+import numpy as np
 
 # Sizes are hardcoded (for now)
 plot_width = 1000
 plot_height = 500
+plotlyjs_cdn = 'https://cdn.plot.ly/plotly-1.58.5.min.js'  # Last plotly.js that knows titlefont
+template_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates', 'combined_template.html')
+
+# Classes used by facebook in the html export (they change between export versions)
+message_class = 'pam _3-95 _2pi0 _2lej uiBoxWhite noborder'  # was previously 'message'
+user_class = '_3-96 _2pio _2lek _2lel'  # was once 'user'
+text_class = '_3-96 _2let'
+timestamp_class = '_3-94 _2lem'  # was once 'meta'
+call_class = '_idm'
+reaction_class = '_tqp'  # List of reactions under a message, one li per reaction
+
+# Conversion tables, relative to this file so the script can be run from anywhere
+conversion_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'conversion')
+conversion_files = {'char_dict': 'bad_unicode_fix.txt',
+                    'ascii_to_emoji_dict': 'ascii_to_emoji.txt',
+                    'month_converter': 'month_converter.txt'}
+_conversion_cache = {}  # Filled by load_conversion_tables
+
+# html tags in message texts, with contents and end tag if there is one
+tag_regex = re.compile(r'<([a-zA-Z][a-zA-Z0-9]*)((?:\s[^<>]*)?)/?>(?:(.*?)</\1\s*>)?', re.DOTALL)
+attribute_regex = re.compile(r'''(href|src)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+))''', re.IGNORECASE)
+tag_types = {'img': 'photo', 'video': 'video', 'audio': 'audio', 'a': 'link'}
+
+# Attachments counted per message, in the order of the MessageTable.media columns
+media_types = ('photo', 'video', 'audio', 'gif', 'sticker', 'file', 'link')
+media_index = {kind: number for number, kind in enumerate(media_types)}
+no_media = (0,) * len(media_types)  # Shared by every message without attachments
+media_folders = {'photos': 'photo', 'videos': 'video', 'audio': 'audio', 'gifs': 'gif',
+                 'stickers_used': 'sticker', 'files': 'file'}  # Export folder of the attachment file
+json_media = {'photos': 'photo', 'videos': 'video', 'audio_files': 'audio', 'gifs': 'gif',
+              'sticker': 'sticker', 'files': 'file', 'share': 'link'}  # Message keys in json exports
+
+# Call durations like "Längd: 1 timme 5 minuter" or "Duration: 30 seconds"
+call_unit_regex = re.compile(r'(\d+)\s*(tim|hour|min|sek|sec)', re.IGNORECASE)
+call_units = {'tim': 3600, 'hour': 3600, 'min': 60, 'sek': 1, 'sec': 1}
+
+# json exports, see iter_json_array
+json_chunk_size = 1024**2  # Characters read at a time
+json_separator_regex = re.compile(r'[\s,]*')
+
+# Words for search and word stats, see tokenize
+word_regex = re.compile(r'\w+')
+word_ngrams = (1, 2)  # Single words and pairs of words in word_stats
+word_capacity = 10000  # Max words (or n-grams) kept per user and n in word_stats, bounds the memory
+word_chunk = 10000  # Messages counted exactly before they are added to the summaries
+top_words = 20
+
+# Reply times and sessions, see flow_stats
+session_gap = 60 * 60  # Seconds without messages that start a new session
+# Reply time histogram bucket edges in seconds, the last bucket is everything above the last edge
+reply_edges = np.array([0, 1, 2, 3, 5, 10, 15, 30, 60, 120, 240, 480, 720, 1440, 2880, 10080]) * 60
+
+# Parsed exports are saved here, see load_table_cached
+cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache')
+cache_version = 3  # Change if the cache format or the parsing changes
+cache_max_size = 1024**3  # Bytes, least recently used entries are removed above this
+incremental_dir = os.path.join(cache_dir, 'incremental')  # Running stats, see update_incremental
+incremental_version = 5  # Change if the saved stats are counted differently
+incremental_anchor_size = 3  # Newest messages hashed together to find where the last run stopped
+cache_columns = ('user_codes', 'timestamps', 'utc_offsets', 'call_times', 'word_counts', 'media', 'reactions',
+                 'text_offsets')
+
+# Timestamp formats per export language, used by parse_timestamps
+# Month names come from conversion/month_converter.txt (swedish) or conversion/month_converter_<language>.txt
+export_language = 'sv'
+utc_offset_pattern = r'(?: UTC(?P<offset_sign>[+-])(?P<offset_hours>\d{1,2})(?::?(?P<offset_minutes>\d{2}))?)?'
+timestamp_formats = {
+    # den 15 februari 2018 kl. 12:40 UTC+01
+    'sv': r'(?:den )?(?P<day>\d{1,2}) (?P<month>MONTHS) (?P<year>\d{4})(?: kl\.)? (?P<hour>\d{1,2}):(?P<minute>\d{2})',
+    # Thursday, February 15, 2018 at 12:40pm UTC+01
+    'en': r'(?:\w+, )?(?P<month>MONTHS) (?P<day>\d{1,2}), (?P<year>\d{4}),? (?:at )?(?P<hour>\d{1,2}):(?P<minute>\d{2}) ?(?P<ampm>[AaPp][Mm])?',
+    # 2018-02-15 12:40:00 Thursday, from timestamp_fixer
+    'fixed': r'(?P<year>\d{4})-(?P<month>\d{1,2})-(?P<day>\d{1,2}) (?P<hour>\d{1,2}):(?P<minute>\d{2})',
+}
+export_languages = ('en', 'sv')  # Languages exports are downloaded in, fixed is only used inside the script
+
+weekday_dict = {0: 'Monday', 1: 'Tuesday', 2: 'Wednesday', 3: 'Thursday',
+                4: 'Friday', 5: 'Saturday', 6: 'Sunday'}
+
+# Instrumentation, see stage and write_run_report
+stage_times = collections.defaultdict(float)  # Seconds per stage, summed over calls
+stage_calls = collections.Counter()
+counters = collections.Counter()
+show_progress = True  # Turned off in batch workers
+progress_rate = 2  # Max progress updates per second
+log_max_bytes = 1024**2  # logger.log is rotated above this
+
+def setup_logging(filename='logger.log', level=logging.INFO):
+    """Rotating log file, so logger.log does not grow forever"""
+    handler = logging.handlers.RotatingFileHandler(filename, maxBytes=log_max_bytes, backupCount=3,
+                                                   encoding='utf-8')
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(level)
+
+@contextlib.contextmanager
+def stage(name):
+    """Times everything in the with block as stage name"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_times[name] += time.perf_counter() - start
+        stage_calls[name] += 1
+
+@contextlib.contextmanager
+def paused_gc():
+    """The garbage collector runs again and again while millions of small tuples are made, none of them are cycles"""
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+def timed(function):
+    """Decorator, every call of function is timed as a stage with the function name"""
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with stage(function.__name__):
+            return function(*args, **kwargs)
+    return wrapper
+
+def add_stage_time(name, seconds, calls=1):
+    """For hot loops that time themselves, a with block per message costs too much"""
+    stage_times[name] += seconds
+    stage_calls[name] += calls
+
+class ProgressReporter:
+    """
+    # Problem: Printing and timing every message is slow on big exports
+    # Solution: Only look at the clock every check_every updates, and print at most max_rate times per second
+    """
+    def __init__(self, total=None, name='messages', max_rate=None, check_every=256):
+        self.total = total
+        self.name = name
+        self.interval = 1 / (max_rate or progress_rate)
+        self.check_every = check_every
+        self.count = 0
+        self.start = time.perf_counter()
+        self.last_print = 0
+        self.printed = False
+
+    def update(self, amount=1):
+        self.count += amount
+        if self.count % self.check_every >= amount and self.count != self.total:
+            return  # Not time to look at the clock yet
+        now = time.perf_counter()
+        if now - self.last_print >= self.interval or self.count == self.total:
+            self.last_print = now
+            self.show(now)
+
+    def show(self, now):
+        if not show_progress:
+            return
+        if self.total:
+            eta = round((now - self.start) / self.count * (self.total - self.count))
+            s = f'{self.count} out of {self.total} {self.name} done - ETA {eta} seconds'
+        else:
+            s = f'{self.count} {self.name} done'
+        print(s.ljust(79), end='\r')  # ljust clears the end of a longer previous line
+        self.printed = True
+
+    def close(self):
+        if self.printed:
+            self.show(time.perf_counter())
+            print('')  # Clear \r
+
+def write_run_report(filename, extra=None):
+    """Stage timers and counters of this run as json"""
+    report = {'date': datetime.datetime.now().isoformat(timespec='seconds'),
+              'stages': {name: {'seconds': round(seconds, 4), 'calls': stage_calls[name]}
+                         for name, seconds in sorted(stage_times.items())},
+              'counters': dict(counters)}
+    if extra:
+        report.update(extra)
+    folder = os.path.dirname(filename)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    with open(filename, 'w', encoding='utf-8') as file:
+        json.dump(report, file, indent=1, ensure_ascii=False)
+    return report
 
 def get_messages(filename):
-    """Puts all messages in lists
-    Written to be easy to follow, not to be compact"""
+    """Puts all messages in lists, (all_texts, all_users, all_timestamps, total_call_time)
+    Parsed with iter_messages, raw timestamps are all parsed at once, per row parse_timestamps costs more than the parsing"""
+    all_texts, all_users, all_timestamps, total_call_time = collect_messages(iter_messages(filename, raw_timestamps=True))
+    return all_texts, all_users, format_timestamps(all_timestamps, timestamp_language(filename)), total_call_time
 
-    logging.info(f'Opening {filename}')
-    """Main script that finds all data"""
-    # Open file in utf-8, or this will not work
-    with open(filename, 'r', encoding='utf-8') as file:
-        contents = file.read()
+def iter_messages(filename, raw_timestamps=False):
+    """
+    # Problem: Loading the whole file into a bs4 tree needs all of it in memory before it starts
+    # Solution: Let lxml parse the file in chunks and yield each message as soon as its div is closed
+    Yields (text, user, timestamp, call_time, media, reactions), the first four are the values get_messages gives
+    media = attachments of every kind in media_types, reactions = number of reactions to the message
+    raw_timestamps = timestamps as written in the export, for parse_timestamps
+    json exports are read by iter_json_messages
+    """
+    if is_json_export(filename):
+        yield from iter_json_messages(filename, raw_timestamps)
+        return
 
-    logging.info(f'Parsing html with bs4')
-    # "Soupify" contents, so it can be used in parsing
-    parsed_html = BeautifulSoup(contents, 'lxml')
+    logging.info(f'Streaming {filename}')
+    conversions = load_conversion_tables()
+    language = timestamp_language(filename)
 
-    logging.info('Parsing messages')
-    # Find all div tags with class is some wierd stuff, all info can be found with this
-    all_messages = parsed_html.body.find_all('div', attrs={'class': 'pam _3-95 _2pi0 _2lej uiBoxWhite noborder'})
-    # was previously 'message' in class
+    progress = ProgressReporter()
+    clean_time = 0
+    timestamp_time = 0
+    context = etree.iterparse(filename, events=('end',), tag='div', html=True,
+                              encoding='utf-8', huge_tree=True)
+    try:
+        for _, element in context:
+            if element.get('class') != message_class:
+                continue  # Divs inside a message, handled when the message div ends
 
-    logging.info('Fixing corrupted unicode')
-    # For bad unicode symbols
-    with open('conversion/bad_unicode_fix.txt', 'r', encoding='utf-8-sig') as file:
-        contents = file.read()
-        char_dict = json.loads(contents)
+            text, user, timestamp, call_seconds, media, reactions = message_fields(element)
 
-    # For changing ascii smileys to unicode emojis
-    with open('conversion/ascii_to_emoji.txt', 'r', encoding='utf-8-sig') as file:
-        contents = file.read().replace("\\", "\\\\")  # Json cant load \\ :/
-        ascii_to_emoji_dict = json.loads(contents)
-        # only way to fix this :/
-        for key in ascii_to_emoji_dict.keys():
-            if "\\\\" in key:
-                new_key = key.replace('\\\\', '\\')
-                ascii_to_emoji_dict[new_key] = ascii_to_emoji_dict[key]
-                del ascii_to_emoji_dict[key]
+            # Texts
+            text = text.replace('<div>', '')
+            text = text.replace('</div>', '')
+            start = time.perf_counter()
+            text, tags = text_cleaner(text, conversions)
+            clean_time += time.perf_counter() - start
+            if tags:
+                media = add_tag_media(media, tags)
+
+            # Timestamps
+            if not raw_timestamps:
+                start = time.perf_counter()
+                # timestamp_fixer only knew swedish exports, slow per row, load_table parses them all at once
+                timestamp = format_timestamps([timestamp], language)[0]
+                timestamp_time += time.perf_counter() - start
+
+            progress.update()
+            yield text, user, timestamp, call_seconds / 60, media, reactions
 
+            # Free everything parsed so far, memory stays the size of one message
+            element.clear(keep_tail=True)
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+    finally:
+        # Also when the caller stops early, like update_incremental at the anchor
+        del context
+        progress.close()
+        add_stage_time('clean', clean_time)
+        if not raw_timestamps:
+            add_stage_time('timestamp', timestamp_time)
+        counters['messages'] += progress.count
+
+def message_fields(element):
+    """
+    # Problem: One find per field searched the whole message again for every field
+    # Solution: Walk the message once and pick up every field on the way
+    Returns (text, user, timestamp, call seconds, media, reactions), text and timestamp as written in the export
+    """
+    text_node = None
+    user = timestamp = ''
+    call_seconds = 0
+    media = None
+    reaction_lists = []
+    for node in element.iter():
+        node_class = node.get('class')
+        if node_class == text_class:
+            text_node = node
+        elif node_class == user_class:
+            user = element_text(node)
+        elif node_class == timestamp_class:
+            timestamp = element_text(node)
+        elif node_class == call_class:
+            call_seconds = parse_call_seconds(element_text(node))
+        elif node_class == reaction_class:
+            reaction_lists.append(node)
+        elif node.tag in tag_types:
+            url = node.get('href' if node.tag == 'a' else 'src')
+            if url is None or (node.tag == 'a' and len(node)):
+                continue  # Not an attachment, or a link around a thumbnail that is counted itself
+            if media is None:
+                media = list(no_media)
+            media[media_index[media_kind(node.tag, url)]] += 1
+    reactions = sum(len(reaction_list) for reaction_list in reaction_lists)
+    for reaction_list in reaction_lists:
+        reaction_list.clear(keep_tail=True)  # Reactions are not part of the text
+    text = element_text(text_node)
+    return text, user, timestamp, call_seconds, no_media if media is None else tuple(media), reactions
+
+def media_kind(tag, url):
+    """Which of media_types an attachment is, from its tag (a key in tag_types) and url"""
+    if '://' not in url:
+        for folder in url.split('/')[:-1]:
+            if folder in media_folders:
+                return media_folders[folder]
+        if tag == 'a':
+            return 'file'
+    if 'sticker' in url:
+        return 'sticker'
+    return tag_types[tag]
+
+def add_tag_media(media, tags):
+    """media with the attachments text_cleaner found as html tags in the text added"""
+    media = list(media)
+    for tag in tags:
+        if tag['type'] in media_index:
+            media[media_index[tag['type']]] += 1
+    return tuple(media)
+
+def collect_messages(messages):
+    """Puts records from iter_messages in lists, same return as get_messages"""
     all_texts = []
     all_users = []
     all_timestamps = []
     total_call_time = 0
-
-    logging.info('Extracting messages')
-    total_time = 0
-    for number,message in enumerate(all_messages):
-        # ETA time
-        time_cycle = time.time()
-
-        # Texts
-        text = find_text(message)
-        text, tags = text_cleaner(text, char_dict, ascii_to_emoji_dict)
+    for text, user, timestamp, call_time, _, _ in messages:
         all_texts.append(text)
-        # Users
-        # Was once 'span'
-        user = message.find('div', attrs={'class': '_3-96 _2pio _2lek _2lel'}).get_text()
-        # Class was once 'user'
         all_users.append(user)
-
-        # Call time (easiest to do it here)
-        call_time = 0
-        if message.find('span', attrs={'class': '_idm'}) is not None:
-            captured_call_string = message.find('span', attrs={'class': '_idm'}).get_text()
-            captured_call_string = captured_call_string.split(' ')
-            # captured_call_string[0] = Längd or some other junk
-            call_time = int(captured_call_string[1])
-            if 'sec' in captured_call_string[2] or 'sek' in captured_call_string[2]:
-                call_time = call_time / 60  # if second
-            else:
-                pass
+        all_timestamps.append(timestamp)
         total_call_time += call_time
+    return all_texts, all_users, all_timestamps, total_call_time
 
-        # Timestamps
-        timestamp = message.find('div', attrs={'class': '_3-94 _2lem'}).get_text()
-        # Class was once 'meta'
-        timestamp = timestamp_fixer(timestamp)
-        all_timestamps.append(timestamp)
+@timed
+def load_table(filename, language=None):
+    """Streams a conversation straight into a MessageTable, timestamps are parsed all at once at the end"""
+    language = language or timestamp_language(filename)
+    return MessageTable.from_records(iter_messages(filename, raw_timestamps=True), language)
 
-        # Progress
-        progressed_time = time.time() - time_cycle
-        total_time += progressed_time
-        # number + 1 since it starts at 0
-        mean_progressed_time = total_time/(number + 1)
-        eta = round(mean_progressed_time*(len(all_messages) - number))
-        s = f'{number + 1} out of {len(all_messages)} messages done - ETA {eta} seconds'
-        print(' ' * 100, end='\r') # This is quite stupid, but it works when clearing previous line
-        print(s, end='\r')
-    print('')  # Clear \r
-    return all_texts, all_users, all_timestamps, total_call_time
+def is_json_export(filename):
+    return filename.lower().endswith('.json')
+
+def timestamp_language(filename):
+    """Format of the raw timestamps iter_messages gives for filename, see parse_timestamps"""
+    return 'epoch_ms' if is_json_export(filename) else export_language
+
+def export_files(filename):
+    """
+    Files of the conversation, a json conversation can be split in message_1.json, message_2.json...
+    message_1.json has the newest messages, so the parts are read in number order
+    Raises FileNotFoundError if filename does not exist, a wrong path must not look like an empty conversation
+    """
+    if not os.path.isfile(filename):
+        raise FileNotFoundError(f'No such file: {filename}')
+    match = re.fullmatch(r'message_(\d+)\.json', os.path.basename(filename))
+    if match is None:
+        return [filename]
+    parts = {int(match.group(1)): filename}  # Even if the glob does not find it
+    for part in glob.glob(os.path.join(glob.escape(os.path.dirname(filename)), 'message_*.json')):
+        part_match = re.fullmatch(r'message_(\d+)\.json', os.path.basename(part))
+        if part_match is not None and int(part_match.group(1)) > int(match.group(1)):
+            parts[int(part_match.group(1))] = part
+    return [parts[number] for number in sorted(parts)]
 
-def find_text(message):
+def iter_json_messages(filename, raw_timestamps=False):
     """
-    # Problem: Messages are not found in tags, plaintext between tags
-    # Solution: Capture everything that is not a div tag between div tags
-    message = soup object that lies between texts
+    # Problem: Scraping the html depends on obfuscated css classes that change between export versions
+    # Solution: Read the json export instead, one message object at a time (iter_json_array),
+    #           so huge files never have to fit in memory
+    Yields (text, user, timestamp, call_time, media, reactions) like iter_messages, timestamp is epoch milliseconds if raw_timestamps
     """
-    text = message.find('div', attrs={'class': '_3-96 _2let'}).get_text()
-    text = text.replace('<div>', '')
-    text = text.replace('</div>', '')
-    return text
+    logging.info(f'Streaming json {filename}')
+    conversions = load_conversion_tables()
+
+    progress = ProgressReporter()
+    clean_time = 0
+    try:
+        for part in export_files(filename):
+            with open(part, 'r', encoding='utf-8') as file:
+                for message in iter_json_array(file, 'messages'):
+                    start = time.perf_counter()
+                    text, tags = text_cleaner(fix_mojibake(message.get('content', '')), conversions)
+                    clean_time += time.perf_counter() - start
+                    user = fix_mojibake(message.get('sender_name', ''))
+                    call_time = message.get('call_duration', 0) / 60  # Seconds
+                    media = json_message_media(message)
+                    if tags:
+                        media = add_tag_media(media, tags)
+                    timestamp = message['timestamp_ms']
+                    if not raw_timestamps:
+                        timestamp = format_timestamps([timestamp], 'epoch_ms')[0]
+
+                    progress.update()
+                    yield text, user, timestamp, call_time, media, len(message.get('reactions', ()))
+    finally:
+        progress.close()
+        add_stage_time('clean', clean_time)
+        counters['messages'] += progress.count
+
+def json_message_media(message):
+    """Attachments of a json message, counted like message_fields counts them in the html"""
+    media = None
+    for key, kind in json_media.items():
+        value = message.get(key)
+        if not value or (key == 'share' and 'link' not in value):
+            continue  # A share without a link is a shared post, the text has it
+        if media is None:
+            media = list(no_media)
+        media[media_index[kind]] += len(value) if isinstance(value, list) else 1
+    return no_media if media is None else tuple(media)
 
+def iter_json_array(file, key, chunk_size=json_chunk_size):
     """
-    # old, was before with <p>
-    text = u''
+    Yields the items of the array under key in a json file, reading chunk_size characters at a time
+    Only the array is decoded, one item at a time with raw_decode
+    """
+    decoder = json.JSONDecoder()
+    key_regex = re.compile(rf'"{re.escape(key)}"\s*:\s*\[')
+    buffer = ''
     while True:
-        p = message.find_next_sibling()
-        if p == None:  # Prone to buggyness, fix for end of all texts
+        chunk = file.read(chunk_size)
+        if not chunk:
+            return  # No such array
+        buffer += chunk
+        match = key_regex.search(buffer)
+        if match is not None:
             break
-        elif p.name == 'div':
+        buffer = buffer[-len(key) - 64:]  # The key could be cut in two by the chunk
+    buffer = buffer[match.end():]
+    position = 0
+    while True:
+        position = json_separator_regex.match(buffer, position).end()
+        if position < len(buffer) and buffer[position] == ']':
+            return
+        try:
+            if position == len(buffer):
+                raise json.JSONDecodeError('Need more data', buffer, position)
+            item, position = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            # Item cut by the chunk, read more
+            chunk = file.read(chunk_size)
+            if not chunk:
+                raise
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+        yield item
+        if position > chunk_size:
+            buffer = buffer[position:]
+            position = 0
+
+def fix_mojibake(text):
+    """
+    # Problem: Facebook writes the utf-8 bytes in json exports as if they were latin-1 characters, å is Ã¥
+    # Solution: Encode back to the bytes and decode them as utf-8, the whole string at once instead of
+    #           one character at a time like bad_unicode_fix.txt
+    """
+    if text.isascii():
+        return text
+    try:
+        return text.encode('latin-1').decode('utf-8')
+    except UnicodeError:
+        return text  # Not mojibake
+
+class MessageTable:
+    """
+    # Problem: Parallel lists of strings, every plot re-splits and re-parses the timestamps
+    # Solution: Parse once into numpy columns, stats are group-bys on the columns
+    Row order is the export order (newest first)
+    timestamps = int64 epoch seconds (UTC)
+    utc_offsets = seconds to add to get the local time shown in the export
+    user_codes = index into users
+    call_times = minutes
+    media = attachments of every kind in media_types, one column per kind
+    reactions = number of reactions to the message
+    """
+    def __init__(self, texts, users, user_codes, timestamps, call_times, word_counts=None, utc_offsets=None,
+                 media=None, reactions=None):
+        self.texts = texts
+        self.users = users
+        self.user_codes = np.asarray(user_codes, dtype=np.int32)
+        self.timestamps = np.asarray(timestamps, dtype=np.int64)
+        if utc_offsets is None:
+            utc_offsets = np.zeros(len(texts), dtype=np.int32)
+        self.utc_offsets = np.asarray(utc_offsets, dtype=np.int32)
+        self.call_times = np.asarray(call_times, dtype=np.float64)
+        if media is None:
+            media = np.zeros((len(texts), len(media_types)), dtype=np.int32)
+        self.media = np.asarray(media, dtype=np.int32)
+        if reactions is None:
+            reactions = np.zeros(len(texts), dtype=np.int32)
+        self.reactions = np.asarray(reactions, dtype=np.int32)
+        # Precomputed columns, days and times are local
+        if word_counts is None:
+            word_counts = np.fromiter((len(text.split(' ')) for text in texts), dtype=np.int32, count=len(texts))
+        self.word_counts = np.asarray(word_counts, dtype=np.int32)
+        self.local_times = self.timestamps + self.utc_offsets
+        self.days = self.local_times // 86400  # Days since 1970-01-01
+        self.minutes = (self.local_times % 86400) // 60  # Minute of day
+        self.hours = (self.minutes // 60).astype(np.int8)
+        self.weekdays = ((self.days + 3) % 7).astype(np.int8)  # 1970-01-01 was a Thursday, Monday = 0
+
+    @classmethod
+    def from_records(cls, records, language='fixed'):
+        """From (text, user, timestamp, call_time, media, reactions) records, like the ones iter_messages yields
+        language = format of the timestamps, see timestamp_formats"""
+        texts = []
+        users = {}
+        user_codes = []
+        timestamps = []
+        call_times = []
+        media = []
+        reactions = []
+        for text, user, timestamp, call_time, message_media, message_reactions in records:
+            texts.append(text)
+            user_codes.append(users.setdefault(user, len(users)))
+            timestamps.append(timestamp)
+            call_times.append(call_time)
+            media.append(message_media)
+            reactions.append(message_reactions)
+        with stage('timestamp'):
+            timestamps, utc_offsets = parse_timestamps(timestamps, language)
+        media = np.array(media, dtype=np.int32).reshape(len(texts), len(media_types))
+        return cls(texts, list(users), user_codes, timestamps, call_times, utc_offsets=utc_offsets,
+                   media=media, reactions=reactions)
+
+    def __len__(self):
+        return len(self.texts)
+
+    def user_column(self):
+        """User name for every row, like all_users"""
+        return [self.users[code] for code in self.user_codes.tolist()]
+
+    def total_call_time(self):
+        return float(self.call_times.sum())
+
+    def take(self, rows):
+        """New table with only rows (array of row numbers), in that order"""
+        rows = np.asarray(rows, dtype=np.int64)
+        return MessageTable([self.texts[row] for row in rows.tolist()], self.users, self.user_codes[rows],
+                            self.timestamps[rows], self.call_times[rows], self.word_counts[rows],
+                            self.utc_offsets[rows], self.media[rows], self.reactions[rows])
+
+def parse_timestamps(raw_timestamps, language=None):
+    """
+    # Problem: timestamp_fixer does one string at a time, with a datetime object per message
+    # Solution: One regex pass over the whole column, then only numpy arithmetic
+    raw_timestamps = timestamps as written in the export, like den 15 februari 2018 kl. 12:40 UTC+01
+    language = key in timestamp_formats, export_language if not given, or epoch_ms for json exports
+    Returns int64 epoch seconds (UTC) and int32 utc offsets in seconds
+    """
+    language = language or export_language
+    if not len(raw_timestamps):
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32)
+    if language == 'epoch_ms':  # json exports
+        epochs = np.asarray(raw_timestamps, dtype=np.int64) // 1000
+        return epochs, local_utc_offsets(epochs)
+    load_conversion_tables()  # Compiles the regex again if a month table has changed
+    regex, month_converter = timestamp_regex(language)
+
+    # Messages sent in the same minute have the same timestamp, only the distinct ones are parsed
+    distinct = dict.fromkeys(raw_timestamps)
+    distinct = dict(zip(distinct, range(len(distinct))))
+    codes = np.fromiter(map(distinct.__getitem__, raw_timestamps), dtype=np.int64, count=len(raw_timestamps))
+    with paused_gc():
+        matches = regex.findall('\n'.join(distinct))
+        columns = list(zip(*matches))
+    if len(matches) != len(distinct):
+        for timestamp in distinct:  # Slow, only to give a useful error
+            if regex.fullmatch(timestamp.split('\n')[0]) is None or '\n' in timestamp:
+                raise ValueError(f'Timestamp {timestamp!r} does not match the {language} format')
+    names = regex.groupindex
+
+    def column(name, converter=None):
+        # Few distinct strings per column, so convert each once and look the rest up
+        strings = columns[names[name] - 1]
+        values = {string: converter[string] if converter else int(string or 0) for string in set(strings)}
+        return np.fromiter(map(values.__getitem__, strings), dtype=np.int64, count=len(strings))
+
+    year = column('year')
+    month = column('month', {name: int(number) for name, number in month_converter.items()} if month_converter else None)
+    day = column('day')
+    hour = column('hour')
+    minute = column('minute')
+    if 'ampm' in names:
+        ampm = column('ampm', {'': 0, 'am': 1, 'AM': 1, 'Am': 1, 'aM': 1, 'pm': 2, 'PM': 2, 'Pm': 2, 'pM': 2})
+        hour = np.where((ampm == 2) & (hour < 12), hour + 12, np.where((ampm == 1) & (hour == 12), 0, hour))
+
+    # UTC+01, UTC-03, UTC+05:30, missing means UTC
+    sign = column('offset_sign', {'': 1, '+': 1, '-': -1})
+    utc_offsets = (sign * (column('offset_hours') * 3600 + column('offset_minutes') * 60)).astype(np.int32)
+
+    # 31 februari would silently be 3 mars, timestamp_fixer raised for it
+    next_year = year + (month == 12)
+    next_month = month % 12 + 1
+    month_days = days_from_civil(next_year, next_month, np.ones_like(day)) - days_from_civil(year, month, np.ones_like(day))
+    invalid = (month < 1) | (month > 12) | (day < 1) | (day > month_days) | (hour > 23) | (minute > 59)
+    if invalid.any():
+        raise ValueError(f'Timestamp {list(distinct)[int(np.argmax(invalid))]!r} is not a real date')
+
+    local_times = days_from_civil(year, month, day) * 86400 + hour * 3600 + minute * 60
+    return (local_times - utc_offsets)[codes], utc_offsets[codes]
+
+def local_utc_offsets(epochs):
+    """
+    UTC offset of this computer's time zone at every epoch, json exports only have UTC times
+    Offsets only change on quarter hours, so only the distinct quarter hours are looked up
+    """
+    quarters, index = np.unique(epochs // 900, return_inverse=True)
+    utc_offsets = np.array([time.localtime(quarter * 900).tm_gmtoff for quarter in quarters.tolist()], dtype=np.int32)
+    return utc_offsets[index.reshape(-1)]
+
+def days_from_civil(year, month, day):
+    """Days since 1970-01-01 for arrays of dates, proleptic gregorian"""
+    year = year - (month <= 2)
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * (month + np.where(month > 2, -3, 9)) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    return era * 146097 + day_of_era - 719468
+
+@functools.lru_cache(maxsize=None)
+def timestamp_regex(language):
+    """Compiled regex for one row of language and its month table (None if months are numbers)"""
+    pattern = timestamp_formats[language]
+    month_converter = None
+    if 'MONTHS' in pattern:
+        filename = 'month_converter.txt' if language == 'sv' else f'month_converter_{language}.txt'
+        with open(os.path.join(conversion_dir, filename), 'r', encoding='utf-8-sig') as file:
+            month_converter = json.loads(file.read())
+        months = '|'.join(re.escape(name) for name in sorted(month_converter, key=len, reverse=True))
+        pattern = pattern.replace('MONTHS', months)
+    # One match per line, anything after the timestamp on the line is skipped
+    return re.compile(f'^{pattern}{utc_offset_pattern}[^\n]*$', re.MULTILINE), month_converter
+
+def format_timestamp(epoch):
+    """1518698400 -> 2018-02-15 12:40:00 Thursday, same format as timestamp_fixer"""
+    datetime_obj = datetime.datetime.fromtimestamp(int(epoch), datetime.timezone.utc)
+    return datetime_obj.strftime('%Y-%m-%d %H:%M:%S ') + weekday_dict[datetime_obj.weekday()]
+
+def format_timestamps(raw_timestamps, language=None):
+    """Raw timestamps (see parse_timestamps) -> local times formatted like format_timestamp"""
+    epochs, utc_offsets = parse_timestamps(raw_timestamps, language)
+    return [format_timestamp(local_time) for local_time in (epochs + utc_offsets).tolist()]
+
+def load_table_cached(filename, refresh=False, max_size=cache_max_size):
+    """
+    # Problem: Every run parses the whole export again, even if only the plots change
+    # Solution: Save the parsed table on disk, keyed by the file contents and the conversion tables
+    refresh = parse again even if there is a cached table
+    max_size = cache size in bytes before old entries are removed, None to not evict
+    """
+    path = os.path.join(cache_dir, cache_key(filename))
+    if not refresh and os.path.exists(os.path.join(path, 'meta.json')):
+        logging.info(f'Loading {filename} from cache {path}')
+        os.utime(os.path.join(path, 'meta.json'))  # Mark as recently used
+        return read_table_cache(path)
+
+    table = load_table(filename)
+    write_table_cache(table, path, filename)
+    if max_size is not None:
+        evict_cache(max_size)
+    return table
+
+def cache_key(filename):
+    """sha256 of the export, the conversion files, the export language and the cache version"""
+    sha = hashlib.sha256(f'{cache_version} {export_language}'.encode())
+    hash_files(sha, export_files(filename) + conversion_paths())
+    return sha.hexdigest()
+
+def conversion_paths():
+    """Conversion files and the month tables of every language"""
+    names = set(conversion_files.values())
+    names.update(os.path.basename(path) for path in glob.glob(os.path.join(conversion_dir, 'month_converter*.txt')))
+    return [os.path.join(conversion_dir, name) for name in sorted(names)]
+
+def hash_files(sha, paths):
+    """Feeds the contents of every file in paths to sha"""
+    for path in paths:
+        with open(path, 'rb') as file:
+            for chunk in iter(functools.partial(file.read, 1024**2), b''):
+                sha.update(chunk)
+    return sha
+
+def write_table_cache(table, path, filename):
+    """Columns as .npy files so they can be memory-mapped, texts as one utf-8 file with offsets"""
+    text_offsets = np.zeros(len(table) + 1, dtype=np.int64)
+    text_offsets[1:] = np.cumsum([len(text) for text in table.texts])  # In characters
+    columns = {'user_codes': table.user_codes,
+               'timestamps': table.timestamps,
+               'utc_offsets': table.utc_offsets,
+               'call_times': table.call_times,
+               'word_counts': table.word_counts,
+               'media': table.media,
+               'reactions': table.reactions,
+               'text_offsets': text_offsets}
+
+    # Write to a temporary folder and rename, a crash never leaves half a cache entry
+    temporary_path = f'{path}.{os.getpid()}.tmp'
+    os.makedirs(temporary_path, exist_ok=True)
+    for name in cache_columns:
+        np.save(os.path.join(temporary_path, f'{name}.npy'), columns[name])
+    with open(os.path.join(temporary_path, 'texts.txt'), 'w', encoding='utf-8', errors='surrogatepass', newline='') as file:
+        file.write(''.join(table.texts))
+    with open(os.path.join(temporary_path, 'meta.json'), 'w', encoding='utf-8') as file:
+        json.dump({'filename': os.path.abspath(filename), 'users': table.users,
+                   'messages': len(table), 'version': cache_version}, file, ensure_ascii=False)
+    if os.path.exists(path):  # Refreshed
+        shutil.rmtree(path, ignore_errors=True)
+    try:
+        os.replace(temporary_path, path)
+    except OSError:  # Another process cached the same file first
+        shutil.rmtree(temporary_path, ignore_errors=True)
+
+def read_table_cache(path):
+    """Memory-maps the columns written by write_table_cache"""
+    with open(os.path.join(path, 'meta.json'), 'r', encoding='utf-8') as file:
+        meta = json.load(file)
+    columns = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r') for name in cache_columns}
+    with open(os.path.join(path, 'texts.txt'), 'r', encoding='utf-8', errors='surrogatepass', newline='') as file:
+        all_text = file.read()
+    offsets = columns['text_offsets'].tolist()
+    texts = [all_text[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+    return MessageTable(texts, meta['users'], columns['user_codes'], columns['timestamps'],
+                        columns['call_times'], columns['word_counts'], columns['utc_offsets'],
+                        columns['media'], columns['reactions'])
+
+def evict_cache(max_size=cache_max_size):
+    """Removes least recently used cache entries until the cache is smaller than max_size bytes"""
+    if not os.path.isdir(cache_dir):
+        return
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        meta = os.path.join(path, 'meta.json')
+        if not os.path.exists(meta):
+            continue  # Being written
+        size = sum(entry.stat().st_size for entry in os.scandir(path))
+        entries.append((os.stat(meta).st_mtime, size, path))
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):  # Oldest first
+        if total_size <= max_size:
             break
-        elif p.name == 'p':
-            text += str(p)
-            message = p  # overwrite section, or it will loop forever
-        else:
-            text += str(p)
-            message = p  # overwrite section, or it will loop forever
-    return text
+        logging.info(f'Removing {path} from cache')
+        shutil.rmtree(path, ignore_errors=True)
+        total_size -= size
+
+def update_incremental(filename, state_path=None):
     """
+    # Problem: A new download is the old conversation plus new messages, everything is computed again
+    # Solution: Save running stats and a hash of the newest messages. Next time, stream from the newest
+    # message and stop at the saved hash, only the new messages are parsed and added to the stats
+    state_path = json file with the running stats, one per conversation folder by default
+    Returns the state dict, see new_incremental_state
+    """
+    if state_path is None:
+        thread = os.path.basename(os.path.dirname(os.path.abspath(filename)))
+        state_path = os.path.join(incremental_dir, f'{thread}.json')
+    conversions_version = hash_files(hashlib.sha256(export_language.encode()), conversion_paths()).hexdigest()
+
+    state = None
+    if os.path.exists(state_path):
+        with open(state_path, 'r', encoding='utf-8') as file:
+            state = json.load(file)
+        if state['conversions_version'] != conversions_version or state['version'] != incremental_version:
+            logging.info('Conversion tables changed, incremental stats are computed again')
+            state = None
+    anchor = state['anchor'] if state is not None else None
+    anchor_size = state['anchor_size'] if state is not None else 0
+    if not anchor_size:
+        anchor = None  # Saved from an empty export, every message is new
+
+    # Exports are newest first, so new messages come before the ones already counted
+    new_records = []
+    digests = []
+    found_anchor = False
+    # closing, so the parser stops and adds its timers and counters right away when the anchor is found
+    with contextlib.closing(iter_messages(filename, raw_timestamps=True)) as records:
+        for record in records:
+            new_records.append(record)
+            # Only what never changes, reactions to the newest messages often come after the download
+            text, user, timestamp = record[:3]
+            digests.append(hashlib.sha1(repr((text, user, timestamp)).encode('utf-8', 'surrogatepass')).hexdigest())
+            # Not before anchor_size messages are seen, a shorter window can not be the saved one
+            if anchor is not None and len(digests) >= anchor_size:
+                window = digests[len(digests) - anchor_size:]
+                if hashlib.sha1(''.join(window).encode()).hexdigest() == anchor:
+                    found_anchor = True
+                    break  # Rest of the file is already counted
+
+    if found_anchor:
+        del new_records[len(new_records) - anchor_size:]  # The anchor messages are old
+        logging.info(f'{len(new_records)} new messages in {filename}')
+    else:
+        if state is not None:
+            logging.info(f'{filename} does not continue the saved stats, computing everything again')
+        state = new_incremental_state(conversions_version)
+
+    table = MessageTable.from_records(new_records, timestamp_language(filename))
+    merge_incremental_state(state, table)
+
+    anchor_size = min(incremental_anchor_size, len(digests))
+    if new_records or anchor is None:
+        # No anchor for an empty export, the hash of no messages would match at the first message next time
+        state['anchor'] = hashlib.sha1(''.join(digests[:anchor_size]).encode()).hexdigest() if anchor_size else None
+        state['anchor_size'] = anchor_size
+
+    os.makedirs(os.path.dirname(os.path.abspath(state_path)), exist_ok=True)
+    with open(state_path, 'w', encoding='utf-8') as file:
+        json.dump(state, file, ensure_ascii=False)
+    return state
+
+def new_incremental_state(conversions_version):
+    """Running stats of one conversation, per user dicts"""
+    return {'version': incremental_version,
+            'conversions_version': conversions_version,
+            'anchor': None,
+            'anchor_size': 0,
+            'total_messages': 0,
+            'newest_timestamp': None,
+            'messages': {},
+            'words': {},
+            'call_time': {},
+            'reactions': {},
+            'attachments': {},
+            'emojis': {},
+            'days': {}}
+
+def merge_incremental_state(state, table):
+    """Adds the messages in table to the running stats"""
+    if not len(table):
+        return
+    state['total_messages'] += len(table)
+    state['newest_timestamp'] = format_timestamp(table.local_times[0])
+
+    totals = user_totals(table)
+    messages, words, call_time = totals['messages'], totals['words'], totals['call_time']
+    reactions, media = totals['reactions'], totals['media']
+    day_counts, days = aggregate(table, 'day')
+    days = [day.strftime('%Y-%m-%d') for day in days]
+    for code, user in enumerate(table.users):
+        state['messages'][user] = state['messages'].get(user, 0) + int(messages[code])
+        state['words'][user] = state['words'].get(user, 0) + int(words[code])
+        state['call_time'][user] = state['call_time'].get(user, 0) + float(call_time[code])
+        state['reactions'][user] = state['reactions'].get(user, 0) + int(reactions[code])
+        user_media = state['attachments'].setdefault(user, dict.fromkeys(media_types, 0))
+        for kind, count in zip(media_types, media[code].tolist()):
+            user_media[kind] += int(count)
+        user_days = state['days'].setdefault(user, {})
+        for day_index in np.flatnonzero(day_counts[code]).tolist():
+            user_days[days[day_index]] = user_days.get(days[day_index], 0) + int(day_counts[code][day_index])
+
+    emoji_dict, most_used_emojis = emoji_stats(table)
+    for user, emojis in emoji_dict.items():
+        user_emojis = state['emojis'].setdefault(user, {})
+        for emoji, amount in emojis.items():
+            user_emojis[emoji] = user_emojis.get(emoji, 0) + amount
+
+def element_text(element):
+    """lxml version of bs4 get_text()"""
+    return ''.join(element.itertext())
+
+def load_conversion_tables():
+    """Loads the tables used by text_cleaner and timestamp_fixer
+    Loaded once per process, and again only if a file in conversion/ has changed
+    Returns the registry dict, see compile_conversion_tables"""
+    files = {name: os.path.join(conversion_dir, filename) for name, filename in conversion_files.items()}
+    # mtime and size of every file, the month tables of every language too, if they change the cache is stale
+    stats = [os.stat(path) for path in conversion_paths()]
+    version = tuple((stat.st_mtime_ns, stat.st_size) for stat in stats)
+    if _conversion_cache.get('version') != version:
+        logging.info('Loading conversion tables')
+        clear_conversion_cache()
+        _conversion_cache.update(compile_conversion_tables(files))
+        _conversion_cache['version'] = version
+    return _conversion_cache
+
+def clear_conversion_cache():
+    """Forces the next load_conversion_tables to read the files again"""
+    _conversion_cache.clear()
+    timestamp_regex.cache_clear()  # Month tables are read there
+
+def compile_conversion_tables(files):
+    """Reads the conversion files and precompiles them so text_cleaner does not scan the dicts"""
+    # For bad unicode symbols
+    with open(files['char_dict'], 'r', encoding='utf-8-sig') as file:
+        contents = file.read()
+        char_dict = json.loads(contents)
+
+    # For changing ascii smileys to unicode emojis
+    with open(files['ascii_to_emoji_dict'], 'r', encoding='utf-8-sig') as file:
+        contents = file.read().replace("\\", "\\\\")  # Json cant load \\ :/
+        ascii_to_emoji_dict = json.loads(contents)
+        # only way to fix this :/
+        for key in list(ascii_to_emoji_dict.keys()):
+            if "\\\\" in key:
+                new_key = key.replace('\\\\', '\\')
+                ascii_to_emoji_dict[new_key] = ascii_to_emoji_dict[key]
+                del ascii_to_emoji_dict[key]
 
-def text_cleaner(text, char_dict={}, ascii_to_emoji_dict = {}):
+    # Month names in the export language
+    with open(files['month_converter'], 'r', encoding='utf-8') as file:
+        month_converter = json.loads(file.read())
+
+    # Single characters are done with str.translate, the few longer ones (&lt; etc) with one regex
+    char_table = str.maketrans({char: fix for char, fix in char_dict.items() if len(char) == 1})
+    long_chars = [char for char in char_dict if len(char) > 1]
+    char_regex = compile_alternation(long_chars) if long_chars else None
+
+    # All smileys in one regex, longest first so :-)) wins over :-)
+    ascii_regex = compile_alternation(ascii_to_emoji_dict.keys())
+
+    return {'char_dict': char_dict,
+            'ascii_to_emoji_dict': ascii_to_emoji_dict,
+            'month_converter': month_converter,
+            'char_table': char_table,
+            'char_regex': char_regex,
+            'ascii_regex': ascii_regex}
+
+def compile_alternation(keys):
+    """One regex matching any of keys, longest key first"""
+    return re.compile('|'.join(re.escape(key) for key in sorted(keys, key=len, reverse=True)))
+
+def parse_call_seconds(captured_call_string):
+    """Längd: 1 timme 5 minuter -> 3900, Duration: 30 seconds -> 30, any mix of hours, minutes and seconds"""
+    return sum(int(amount) * call_units[unit.lower()] for amount, unit in call_unit_regex.findall(captured_call_string))
+
+def text_cleaner(text, conversions=None):
     """
     # Problem: Messages sometimes messy with ascii emojis, links, pictures, stickers and such
     # Solution: Clean,replace and remove everything unwanted
+    conversions = registry from load_conversion_tables, loaded if not given
     """
-    text = text.replace('<p>', '')  # Remove <p>
-    text = text.replace('</p>', '') # Remove </p>
-
-    # Check for images, videos, stickers etc
-    warnings.filterwarnings("ignore", category=UserWarning, module='bs4')  # Supress URL errors
-    if bool(BeautifulSoup(text, "html.parser").find()):
-        tags = BeautifulSoup(text, "html.parser").find_all()
-        for tag in tags:
-            text = text.replace(str(tag), '')  # Needs to make tag into string
-    else:
-        tags = ['']
-    warnings.filterwarnings("always", category=UserWarning, module='bs4')  # Restart warnings
+    if conversions is None:
+        conversions = load_conversion_tables()
 
+    # Check for images, videos, stickers etc, most messages have no tags at all
+    tags = []
+    if '<' in text:
+        text = text.replace('<p>', '')  # Remove <p>
+        text = text.replace('</p>', '') # Remove </p>
+        text = tag_regex.sub(lambda match: remove_tag(match, tags), text)
     # Fixed bugged symbols, japan/samsung
-    for char in text:
-        if char in char_dict.keys():
-            text = text.replace(char, char_dict[char])
+    text = text.translate(conversions['char_table'])
+    if conversions['char_regex'] is not None:
+        char_dict = conversions['char_dict']
+        text = conversions['char_regex'].sub(lambda match: char_dict[match.group()], text)
 
     # Fix ascii smileys to unicode
-    for ascii_emoji in ascii_to_emoji_dict.keys():
-        if ascii_emoji in text:
-            text = text.replace(ascii_emoji, ascii_to_emoji_dict[ascii_emoji])
+    ascii_to_emoji_dict = conversions['ascii_to_emoji_dict']
+    text = conversions['ascii_regex'].sub(lambda match: ascii_to_emoji_dict[match.group()], text)
 
     return text, tags
 
-def timestamp_fixer(timestamp):
+def remove_tag(match, tags):
+    """Used by text_cleaner, saves a matched tag (and tags inside it) in tags and removes it from the text"""
+    name = match.group(1).lower()
+    url = None
+    for attribute in attribute_regex.finditer(match.group(2)):
+        url = next(value for value in attribute.groups()[1:] if value is not None)
+        if attribute.group(1).lower() == 'href':
+            break  # Link is more interesting than the thumbnail
+    tag_type = media_kind(name, url) if name in tag_types and url is not None else name
+    tag = {'type': tag_type, 'url': url}
+    tags.append(tag)
+    if match.group(3):
+        inner_tags = []
+        tag_regex.sub(lambda inner_match: remove_tag(inner_match, inner_tags), match.group(3))
+        if name == 'a' and inner_tags:
+            # A link around a thumbnail is the attachment it opens, like message_fields counts it
+            tag['type'] = inner_tags.pop(0)['type']
+        tags.extend(inner_tags)
+    return ''
+
+def timestamp_fixer(timestamp, month_converter=None):
     """
     # Problem: Messages are in a bad format, cannot be used to make datetime objects
     # Solution: Replace and reformat all dates, converting
@@ -175,8 +995,8 @@ def timestamp_fixer(timestamp):
     to
     2018-02-15 12:40:00 Thursday
     Month dict is in swedish, change conversion file if another language is used"""
-    with open('conversion/month_converter.txt', 'r', encoding='utf-8') as file:
-        month_converter = json.loads(file.read())
+    if month_converter is None:
+        month_converter = load_conversion_tables()['month_converter']
     timestamp = timestamp.split(' ')
     # timestamp[0] = den
     day = timestamp[1]
@@ -187,8 +1007,6 @@ def timestamp_fixer(timestamp):
     # timestamp[6] = timezone, might be useful?
     timestamp = f'{year}-{month}-{day} {hour_minute}:00'
     datetime_obj = datetime.date(int(year), int(month), int(day))
-    weekday_dict = {0: 'Monday', 1: 'Tuesday', 2: 'Wednesday', 3: 'Thursday',
-                    4: 'Friday', 5: 'Saturday', 6: 'Sunday'}
     timestamp = timestamp + ' ' + weekday_dict[datetime_obj.weekday()]
     return timestamp
 
@@ -222,219 +1040,516 @@ def fix_emoji_table(filename):
         json.dump(char_dict, outfile)
         #char_dict = json.loads(contents)
 
-def emoji_stats(all_texts, all_users):
-    """Emojis starts at int('1f600',16)
-    counts all chars that fall in this range for each message"""
+@timed
+def emoji_stats(table):
+    """
+    # Problem: Emojis are often several characters (skin tones, flags, zwj families), char by char misses them
+    # Solution: Match whole sequences with a trie regex built from the emoji package, count with Counters
+    Chars above 128512 (int('1f600',16)) are counted too, like before (<3 seems to be under 128512)
+    """
+    # All texts of a user in one string, so the regex work is done in C and not per message
+    user_texts = [[] for _ in table.users]
+    for code, text in zip(table.user_codes.tolist(), table.texts):
+        if not text.isascii():  # Ascii smileys are already unicode after text_cleaner
+            user_texts[code].append(text)
+
     # Make dict for each user, smiley and value
     emoji_dict = {}
-    emoji_total_dict = {}
-    for user, text in zip(all_users, all_texts):
-        for char in text:
-            if char in emoji_module.UNICODE_EMOJI or ord(char) > 128512:  # <3 seems to be under 128512
-                if not user in emoji_dict.keys():
-                    emoji_dict[user] = {}
-                if not char in emoji_dict[user].keys():
-                    emoji_dict[user][char] = 0
-                if not char in emoji_total_dict.keys():
-                    emoji_total_dict[char] = 0
-
-                emoji_dict[user][char] += 1
-                emoji_total_dict[char] += 1
-
-    sorted_values, sorted_emojis = zip(*sorted(zip(emoji_total_dict.values(),
-                                            emoji_total_dict.keys()),
-                                        reverse=True))
-    most_used_emojis = sorted_emojis[:20]  # 20 most used
+    emoji_total_dict = collections.Counter()
+    for code, texts in enumerate(user_texts):
+        counter = collections.Counter(find_emojis('\n'.join(texts)))
+        if counter:
+            emoji_dict[table.users[code]] = dict(counter)
+            emoji_total_dict.update(counter)
+
+    # 20 most used, no need to sort all of them
+    most_used_emojis = tuple(emoji for emoji, _ in heapq.nlargest(20, emoji_total_dict.items(),
+                                                                   key=operator.itemgetter(1)))
     return emoji_dict, most_used_emojis
 
-def count_words(all_texts):
-    amount_of_words = 0
-    for text in all_texts:
-        word_list = text.split(' ')
-        amount_of_words += len(word_list)
+def find_emojis(text):
+    """All emojis in text, whole sequences like 👍🏽 or 🇸🇪 are one emoji"""
+    candidate_regex, sequence_regex, keycap_regex = emoji_regexes()
+    emojis = []
+    position = 0
+    # Jump between chars that can start an emoji, the trie regex is only tried there
+    while True:
+        candidate = candidate_regex.search(text, position)
+        if candidate is None:
+            break
+        sequence = sequence_regex.match(text, candidate.start())
+        if sequence is None:
+            position = candidate.start() + 1
+        else:
+            emojis.append(sequence.group())
+            position = sequence.end()
+    if '\u20e3' in text:  # Keycaps like 1️⃣ are the only emojis starting with an ascii char
+        emojis.extend(keycap_regex.findall(text))
+    return emojis
+
+@functools.lru_cache(maxsize=None)
+def emoji_regexes():
+    """Regexes used by find_emojis, compiled once from the emojis in the emoji package
+    candidate_regex = chars that can start an emoji (a few ranges, fast to search for)
+    sequence_regex = trie of every emoji sequence, longest sequence wins
+    keycap_regex = emojis starting with an ascii char"""
+    import emoji as emoji_module
 
-    return amount_of_words
+    if hasattr(emoji_module, 'EMOJI_DATA'):  # emoji >= 2.0
+        sequences = emoji_module.EMOJI_DATA.keys()
+    else:
+        sequences = emoji_module.UNICODE_EMOJI
+        sequences = sequences.get('en', sequences)  # emoji 1.x has one dict per language
+    keycaps = [sequence for sequence in sequences if sequence[0].isascii()]
 
-def unique(list_of_things):
-    """Util, debug this!!
-    Problem: Set function inbuilt does NOT keep order...
-    Solution: Make function yourself that does this"""
-    unique_list = []
-    for item in list_of_things:
-        if item not in unique_list:
-            unique_list.append(item)
-    return unique_list
+    trie = {}
+    for sequence in sequences:
+        if sequence[0].isascii():
+            continue
+        node = trie
+        for char in sequence:
+            node = node.setdefault(char, {})
+        node[''] = {}  # End of a sequence
+    sequence_regex = re.compile(f'{trie_regex(trie)}|[\U0001F601-\U0010FFFF]')
 
-def plot_emoji_stats(emoji_dict, most_used_emojis):
+    # First chars merged into ranges, a char class with thousands of single chars is slow
+    first_chars = sorted(ord(char) for char in trie)
+    ranges = [[first_chars[0], first_chars[0]]]
+    for char in first_chars[1:]:
+        if char - ranges[-1][1] <= 64:
+            ranges[-1][1] = char
+        else:
+            ranges.append([char, char])
+    candidate_regex = re.compile('[' + ''.join(f'{re.escape(chr(start))}-{re.escape(chr(end))}'
+                                               for start, end in ranges) + '\\U0001F601-\\U0010FFFF]')
+    keycap_regex = compile_alternation(keycaps) if keycaps else re.compile('(?!)')
+    return candidate_regex, sequence_regex, keycap_regex
+
+def trie_regex(trie):
+    """
+    # Problem: An alternation of thousands of emojis is slow, the regex tries every one at every char
+    # Solution: Make the alternation a trie, so only the branch of the first char is tried
+    """
+    leaf_chars = []
+    alternatives = []
+    for char in sorted(key for key in trie if key):
+        regex = trie_regex(trie[char])
+        if regex:
+            alternatives.append(re.escape(char) + regex)
+        else:
+            leaf_chars.append(re.escape(char))
+    if len(leaf_chars) == 1:
+        alternatives.append(leaf_chars[0])
+    elif leaf_chars:
+        alternatives.append('[' + ''.join(leaf_chars) + ']')
+    if not alternatives:
+        return ''
+    regex = alternatives[0] if len(alternatives) == 1 and '' not in trie else '(?:' + '|'.join(alternatives) + ')'
+    if '' in trie:
+        regex += '?'  # Greedy, the longest sequence wins
+    return regex
+
+def tokenize(text):
+    """Lowercase words of a message text, emojis and punctuation are not words"""
+    return word_regex.findall(text.lower())
+
+def count_words(table):
+    return int(table.word_counts.sum())
+
+class SpaceSaving:
+    """
+    # Problem: A Counter of every word (and every pair of words) in a big export does not fit in memory
+    # Solution: SpaceSaving keeps at most capacity items, a new item takes the place of the least counted one
+    #           and starts from its count. Counts are never too low, and are too high by at most errors[item].
+    #           Every item seen more than total / capacity times is kept
+    """
+    def __init__(self, capacity=word_capacity):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self.total = 0
+        self.heap = []  # (count, item) of every kept item, an item's count can have grown since it was pushed
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add(self, item, count=1):
+        self.total += count
+        if item in self.counts:
+            self.counts[item] += count
+            return
+        error = 0
+        if len(self.counts) >= self.capacity:
+            error, smallest = self.pop_smallest()
+            del self.counts[smallest]
+            del self.errors[smallest]
+        self.counts[item] = error + count
+        self.errors[item] = error
+        heapq.heappush(self.heap, (error + count, item))
+
+    def update(self, counts):
+        """Adds every item of a dict or Counter of counts"""
+        for item, count in counts.items():
+            self.add(item, count)
+
+    def pop_smallest(self):
+        """(count, item) with the lowest count, removed from the heap"""
+        while True:
+            count, item = heapq.heappop(self.heap)
+            if item not in self.counts:
+                continue  # Replaced already
+            if self.counts[item] != count:
+                heapq.heappush(self.heap, (self.counts[item], item))  # Grew since it was pushed
+                continue
+            return count, item
+
+    def minimum(self):
+        """Count an item that is not kept can have at most"""
+        if len(self.counts) < self.capacity:
+            return 0
+        count, item = self.pop_smallest()
+        heapq.heappush(self.heap, (count, item))
+        return count
+
+    def merge(self, other):
+        """
+        New summary of both streams, for summaries from different workers or conversations
+        An item one summary does not keep can have had up to that summary's minimum there
+        """
+        minimum, other_minimum = self.minimum(), other.minimum()
+        merged = SpaceSaving(max(self.capacity, other.capacity))
+        counts = {}
+        for item in set(self.counts) | set(other.counts):
+            count = self.counts.get(item, minimum) + other.counts.get(item, other_minimum)
+            error = self.errors.get(item, minimum) + other.errors.get(item, other_minimum)
+            counts[item] = (count, error)
+        for item, (count, error) in heapq.nlargest(merged.capacity, counts.items(), key=lambda pair: pair[1][0]):
+            merged.counts[item] = count
+            merged.errors[item] = error
+        merged.heap = [(count, item) for item, count in merged.counts.items()]
+        heapq.heapify(merged.heap)
+        merged.total = self.total + other.total
+        return merged
+
+    def top(self, k=top_words):
+        """k most counted (item, count), most counted first"""
+        return heapq.nlargest(k, self.counts.items(), key=operator.itemgetter(1))
+
+def ngrams(tokens, n):
+    """Words joined with spaces, n at a time"""
+    if n == 1:
+        return tokens
+    return [' '.join(tokens[start:start + n]) for start in range(len(tokens) - n + 1)]
+
+@timed
+def word_stats(table, sizes=word_ngrams, capacity=word_capacity):
+    """
+    Most used words and n-grams (n in sizes) in total and per user, from the cleaned texts
+    Chunks of word_chunk messages are counted exactly and added to SpaceSaving summaries,
+    so memory is bounded by the chunk size and capacity, not by the export size
+    Returns {n: SpaceSaving} and {user: {n: SpaceSaving}}
+    """
+    total_summaries = {n: SpaceSaving(capacity) for n in sizes}
+    user_summaries = {user: {n: SpaceSaving(capacity) for n in sizes} for user in table.users}
+    user_codes = table.user_codes.tolist()
+    for start in range(0, len(table), word_chunk):
+        chunk_counts = [{n: collections.Counter() for n in sizes} for _ in table.users]
+        for code, text in zip(user_codes[start:start + word_chunk], table.texts[start:start + word_chunk]):
+            tokens = tokenize(text)
+            for n, counter in chunk_counts[code].items():
+                counter.update(ngrams(tokens, n))
+        for user, counters in zip(table.users, chunk_counts):
+            for n, counter in counters.items():
+                user_summaries[user][n].update(counter)
+                total_summaries[n].update(counter)
+    return total_summaries, user_summaries
+
+def word_lines(total_summaries, k=10):
+    """Most used words and n-grams, for the text stats"""
+    names = {1: 'words', 2: 'pairs of words'}
+    return ['Most used {}: {}'.format(names.get(n, f'{n} words in a row'),
+                                      ', '.join(f'{item} ({count})' for item, count in summary.top(k)))
+            for n, summary in total_summaries.items()]
+
+def bucket_by_day(table):
+    """Day of message, every day from first to last message gets a bucket"""
+    first_day = int(table.days.min()) if len(table) else 0
+    last_day = int(table.days.max()) if len(table) else -1
+    days = np.arange(first_day, last_day + 1)
+    labels = (days * 86400).astype('datetime64[s]').astype(datetime.datetime).tolist()
+    return table.days - first_day, labels
+
+def bucket_by_weekday(table):
+    """Monday first"""
+    return table.weekdays, [weekday_dict[weekday] for weekday in range(7)]
+
+def bucket_by_half_hour(table):
+    """Round to closest half hour, 23:50 is 00:00"""
+    half_hours = ((table.minutes + 15) // 30) % 48
+    # Need date in correct format to sort
+    labels = [f'2012-12-12 {half_hour // 2:02d}:{half_hour % 2 * 30:02d}:00' for half_hour in range(48)]
+    return half_hours, labels
+
+def bucket_by_week(table):
+    """Every week (Monday to Sunday) from first to last message gets a bucket, labeled with its Monday"""
+    weeks = (table.days + 3) // 7  # Weeks since the Monday before 1970-01-01
+    first_week = int(weeks.min()) if len(table) else 0
+    last_week = int(weeks.max()) if len(table) else -1
+    mondays = np.arange(first_week, last_week + 1) * 7 - 3
+    labels = [str(monday) for monday in mondays.astype('datetime64[D]')]
+    return weeks - first_week, labels
+
+def bucket_by_month(table):
+    """Every month from first to last message gets a bucket"""
+    months = table.local_times.astype('datetime64[s]').astype('datetime64[M]').astype(np.int64)
+    first_month = int(months.min()) if len(table) else 0
+    last_month = int(months.max()) if len(table) else -1
+    labels = [str(month) for month in np.arange(first_month, last_month + 1).astype('datetime64[M]')]
+    return months - first_month, labels
+
+# Bucketings for aggregate, function(table) -> bucket of every row, label of every bucket
+bucketings = {'day': bucket_by_day,
+              'weekday': bucket_by_weekday,
+              'half_hour': bucket_by_half_hour,
+              'week': bucket_by_week,
+              'month': bucket_by_month}
+
+def aggregate(table, bucketing=None, weights=None):
+    """
+    # Problem: Counting texts per user and timestamp by searching the lists is O(users * days * n)
+    # Solution: One bincount over (user, bucket) pairs, O(n)
+    bucketing = name in bucketings or function(table), None gives one bucket per user
+    weights = column to sum instead of counting rows, like table.word_counts
+              a 2-D column like table.media gives one sum per column, users x buckets x columns
+    Returns counts (users x buckets array) and bucket labels
+    """
+    if bucketing is None:
+        buckets, labels = np.zeros(len(table), dtype=np.int64), ['all']
+    elif callable(bucketing):
+        buckets, labels = bucketing(table)
+    else:
+        buckets, labels = bucketings[bucketing](table)
+    pairs = table.user_codes.astype(np.int64) * len(labels) + buckets
+    if weights is not None and np.ndim(weights) == 2:
+        counts = [np.bincount(pairs, weights=column, minlength=len(table.users) * len(labels))
+                  for column in np.asarray(weights).T]
+        return np.stack(counts, axis=-1).reshape(len(table.users), len(labels), len(counts)), labels
+    counts = np.bincount(pairs, weights=weights, minlength=len(table.users) * len(labels))
+    return counts.reshape(len(table.users), len(labels)), labels
+
+def user_totals(table):
+    """
+    Totals per user, every array is indexed by user code
+    The one place a new column is added to, so the stats, the server and the incremental state agree
+    Returns {'messages', 'words', 'calls', 'reactions': int64, 'call_time': minutes, 'media': users x media_types}
+    """
+    def total(weights=None):
+        return aggregate(table, weights=weights)[0][:, 0]
+    return {'messages': total().astype(np.int64),
+            'words': total(table.word_counts).astype(np.int64),
+            'calls': total(table.call_times > 0).astype(np.int64),
+            'call_time': total(table.call_times),
+            'reactions': total(table.reactions).astype(np.int64),
+            'media': total(table.media).astype(np.int64)}
+
+def media_lines(table):
+    """Attachments, calls and reactions, for the text stats"""
+    totals = user_totals(table)
+    media, calls, call_times, reactions = totals['media'], totals['calls'], totals['call_time'], totals['reactions']
+    lines = []
+    for code, user in enumerate(table.users):
+        sent = ', '.join(f'{count} {kind}' + ('s' if count > 1 and kind != 'audio' else '')
+                         for kind, count in zip(media_types, media[code].tolist()) if count)
+        lines.append('{}: sent {}, {} calls ({} minutes), got {} reactions'.format(
+            user, sent or 'no attachments', int(calls[code]), round(float(call_times[code]), 2), int(reactions[code])))
+    if len(table) and table.call_times.max() > 0:
+        lines.append('Longest call: {} minutes, {}'.format(round(float(table.call_times.max()), 2),
+                                                            format_timestamp(table.local_times[np.argmax(table.call_times)])))
+    return lines
+
+def longest_run(active):
+    """(length, first index) of the longest run of True in active, (0, None) if there is none"""
+    changes = np.flatnonzero(np.diff(np.concatenate(([0], active.astype(np.int8), [0]))))
+    starts, ends = changes[::2], changes[1::2]
+    if not len(starts):
+        return 0, None
+    longest = int(np.argmax(ends - starts))
+    return int(ends[longest] - starts[longest]), int(starts[longest])
+
+@timed
+def flow_stats(table, gap=session_gap, edges=reply_edges):
+    """
+    # Problem: Reply times and sessions compare every message to the one before it, a python loop over
+    #          the pairs is slow and a list of every reply time grows with the export
+    # Solution: One numpy pass over the messages oldest first. Reply times go straight into a histogram
+    #           per user with fixed buckets, so the result is the same size for any export and
+    #           histograms of different conversations can be added
+    A reply is a message from another user than the message before it, the reply time is the time between them
+    A session starts with the first message and after every gap of more than gap seconds
+    Streaks are runs of days in a row with messages, from the same day counts aggregate gives the plots
+    """
+    # Exports are newest first, reversed they are oldest first unless parts were joined out of order
+    order = np.arange(len(table) - 1, -1, -1)
+    times = table.timestamps[order]
+    if np.any(times[1:] < times[:-1]):
+        order = order[np.argsort(times, kind='stable')]
+        times = table.timestamps[order]
+    codes = table.user_codes[order].astype(np.int64)
+    gaps = np.diff(times)
+
+    replies = codes[1:] != codes[:-1]
+    buckets = np.searchsorted(edges, gaps[replies], 'right') - 1
+    reply_histograms = np.bincount(codes[1:][replies] * len(edges) + buckets,
+                                   minlength=len(table.users) * len(edges)).reshape(len(table.users), len(edges))
+
+    starts = np.flatnonzero(np.concatenate(([len(times) > 0], gaps > gap)))
+    ends = np.append(starts[1:], len(times))[:len(starts)] - 1  # Last message of every session
+    durations = times[ends] - times[starts]
+    longest_session = int(np.argmax(durations)) if len(starts) else None
+
+    day_counts, day_labels = aggregate(table, 'day')
+    streak, streak_start = longest_run(day_counts.sum(axis=0) > 0)
+    user_streaks = {}
+    for code, user in enumerate(table.users):
+        length, start = longest_run(day_counts[code] > 0)
+        user_streaks[user] = {'days': length, 'first': day_labels[start].strftime('%Y-%m-%d') if length else None}
+
+    return {'gap': gap,
+            'edges': edges,
+            'reply_histograms': reply_histograms,
+            'sessions': len(starts),
+            'session_starts': np.bincount(codes[starts], minlength=len(table.users)),
+            'session_seconds': int(durations.sum()),
+            'longest_session': None if longest_session is None else
+                               {'seconds': int(durations[longest_session]),
+                                'messages': int(ends[longest_session] - starts[longest_session] + 1),
+                                'first': format_timestamp(table.local_times[order[starts[longest_session]]])},
+            'streak': {'days': streak, 'first': day_labels[streak_start].strftime('%Y-%m-%d') if streak else None},
+            'user_streaks': user_streaks}
+
+def histogram_quantile(counts, edges, q):
+    """
+    Estimated q quantile (0 to 1) of the values in a reply time histogram, linear inside the bucket
+    None without values, the last edge if the quantile is in the last bucket, which has no upper edge
+    """
+    total = int(np.sum(counts))
+    if not total:
+        return None
+    cumulative = np.cumsum(counts)
+    rank = max(q * total, 1)
+    bucket = int(np.searchsorted(cumulative, rank, 'left'))
+    if bucket == len(edges) - 1:
+        return float(edges[-1])
+    fraction = (rank - (cumulative[bucket] - counts[bucket])) / counts[bucket]
+    return float(edges[bucket] + fraction * (edges[bucket + 1] - edges[bucket]))
+
+def format_duration(seconds):
+    """Seconds -> '45 min', '1.5 h' or '2 d'"""
+    if seconds < 3600:
+        return f'{round(seconds / 60, 1):g} min'
+    if seconds < 86400:
+        return f'{round(seconds / 3600, 1):g} h'
+    return f'{round(seconds / 86400, 1):g} d'
+
+def reply_labels(edges):
+    """Bucket labels of the reply time histograms"""
+    return ([f'{format_duration(low)} - {format_duration(high)}' for low, high in zip(edges[:-1], edges[1:])] +
+            [f'{format_duration(edges[-1])} or more'])
+
+def flow_lines(table, flow):
+    """Reply times, sessions and streaks, for the text stats"""
+    lines = []
+    if flow['sessions']:
+        lines.append('Conversations (new after {} without messages): {}, {} messages and {} long on average'.format(
+            format_duration(flow['gap']), flow['sessions'], round(len(table) / flow['sessions'], 1),
+            format_duration(flow['session_seconds'] / flow['sessions'])))
+        longest = flow['longest_session']
+        lines.append('Longest conversation: {} messages in {}, started {}'.format(
+            longest['messages'], format_duration(longest['seconds']), longest['first']))
+    if flow['streak']['days']:
+        lines.append('Longest streak: {} days in a row with messages, from {}'.format(
+            flow['streak']['days'], flow['streak']['first']))
+    for code, user in enumerate(table.users):
+        median = histogram_quantile(flow['reply_histograms'][code], flow['edges'], 0.5)
+        slow = histogram_quantile(flow['reply_histograms'][code], flow['edges'], 0.9)
+        replies = 'no replies' if median is None else 'replies in {} (median), 90% within {}'.format(
+            format_duration(median), format_duration(slow))
+        lines.append('{}: {}, started {} conversations, longest streak {} days'.format(
+            user, replies, int(flow['session_starts'][code]), flow['user_streaks'][user]['days']))
+    return lines
+
+def user_bars(table, counts, labels):
+    """One bar trace per user, for stacked bar plots"""
+    return [{'type': 'bar', 'x': labels, 'y': counts[code].tolist(), 'name': user}
+            for code, user in enumerate(table.users)]
+
+def bar_layout(title, yaxis_title=None):
+    layout = {'barmode': 'stack',
+              'title': title,
+              'width': plot_width,
+              'height': plot_height,
+              'titlefont': {'size': 26}}
+    if yaxis_title is not None:
+        layout['yaxis'] = {'title': yaxis_title}
+    return layout
+
+# Figure builders, plain dicts with the aggregated numbers only
+# Building go.Figure objects validates every point and is slow, plotly.js takes the dicts as they are
+def emoji_figure(emoji_dict, most_used_emojis):
     data = []
     for user in emoji_dict.keys():
-        y = []
-        for emoji in most_used_emojis:
-            if emoji in emoji_dict[user].keys():
-                y.append(emoji_dict[user][emoji])
-            else: # Bug could happen if one user has not written emoji. This should fix it
-                y.append(0)
-        bar_object = go.Bar(x=most_used_emojis,
-                            y=y,
-                            name=user)
-        data.append(bar_object)
-    layout = go.Layout(barmode='stack',
-                       width=plot_width,
-                       height=plot_height,
-                       title='Emoji stats',
-                       titlefont = dict(
-                            size=26)
-                       )
-    fig = go.Figure(data=data, layout=layout)
-    plotly.offline.plot(fig, filename='results/emoji_stats.html', auto_open=False)
-
-def plot_text_frequency_full(all_texts, all_timestamps, all_users):
-    #Only get day, ignore time
-    all_timestamps_copy = list(all_timestamps)  # I need to deep-copy list, list() will do it
-    for index, timestamp in enumerate(all_timestamps_copy):  # Fix dates
-            timestamp = timestamp.split(' ')
-            timestamp = ' '.join(timestamp[:1])  # Ignore weekday, join to string
-            timestamp = datetime.datetime.strptime(timestamp, "%Y-%m-%d")  # Make into time object
-            all_timestamps_copy[index] = timestamp  # Overwrite and make to datetime object
+        # A user that has not written an emoji gets 0
+        y = [emoji_dict[user].get(emoji, 0) for emoji in most_used_emojis]
+        data.append({'type': 'bar', 'x': list(most_used_emojis), 'y': y, 'name': user})
+    return {'data': data, 'layout': bar_layout('Emoji stats')}
 
-    data = []
-    for user in set(all_users):
-        all_timestamps_fixed = []
-        all_texts_fixed = []
-        #pdb.set_trace()
-        for timestamp in unique(all_timestamps_copy):
-            amount_of_texts = 0
-            indices = [i for i, x in enumerate(all_timestamps_copy) if x == timestamp]
-            all_timestamps_fixed.append(timestamp)
-            for index in indices:
-                if user in all_users[index]:
-                    amount_of_texts += 1
-            all_texts_fixed.append(amount_of_texts)
-
-        bar_object = go.Bar(x=all_timestamps_fixed,
-                            y=all_texts_fixed,
-                            name=user)
-        data.append(bar_object)
-
-    layout = go.Layout(barmode='stack',
-                       title='Text stats',
-                       width=plot_width,
-                       height=plot_height,
-                       titlefont=dict(
-                           size=26),
-                       yaxis=dict(title='Texts')
-                       )
-    fig = go.Figure(data=data, layout=layout)
-    plotly.offline.plot(fig, filename='results/texts_stats_full.html', auto_open=False)
-
-def plot_text_frequency_day(all_texts, all_timestamps, all_users):
-
-    #Only get day, ignore time
-    all_timestamps_copy = list(all_timestamps)  # I need to deep-copy list, list() will do it
-    for index, timestamp in enumerate(all_timestamps_copy):  # Fix dates
-            timestamp = timestamp.split(' ')
-            timestamp = timestamp[2]  # Get weekday
-            all_timestamps_copy[index] = timestamp  # Overwrite and make to datetime object
-
-    sort_order = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
-    all_timestamps_copy = sorted(all_timestamps_copy, key=sort_order.index)  # Sort day correct
-    data = []
-    for user in set(all_users):
-        all_timestamps_fixed = []
-        all_texts_fixed = []
-        for timestamp in unique(all_timestamps_copy):
-            amount_of_texts = 0
-            indices = [i for i, x in enumerate(all_timestamps_copy) if x == timestamp]
-            all_timestamps_fixed.append(timestamp)
-            for index in indices:
-                if user in all_users[index]:
-                    amount_of_texts += 1
-            all_texts_fixed.append(amount_of_texts)
-
-        bar_object = go.Bar(x=all_timestamps_fixed,
-                            y=all_texts_fixed,
-                            name=user)
-        data.append(bar_object)
-
-    layout = go.Layout(barmode='stack',
-                       title='Text stats',
-                       width=plot_width,
-                       height=plot_height,
-                       titlefont=dict(
-                           size=26),
-                       yaxis=dict(title='Texts')
-                       )
-    fig = go.Figure(data=data, layout=layout)
-    plotly.offline.plot(fig, filename='results/texts_stats_day.html', auto_open=False)
-
-
-def plot_text_frequency_hour(all_texts, all_timestamps, all_users):
-
-    #Only get day, ignore time
-    all_timestamps_copy = list(all_timestamps)  # I need to deep-copy list, list() will do it
-    for index, timestamp in enumerate(all_timestamps_copy):  # Fix dates
-            timestamp = timestamp.split(' ')
-            timestamp = timestamp[1]  # Remove seconds
-            timestamp = timestamp.split(':')  # Get time
-            if int(timestamp[1]) < 15: # No way to round... round to closest half hour
-                timestamp[1] = '00'
-            elif int(timestamp[1]) < 30:
-                timestamp[1] = '30'
-            elif int(timestamp[1]) < 45:
-                timestamp[1] = '30'
-            elif int(timestamp[1]) < 60:
-                timestamp[1] = '00'
-                timestamp[0] = str(int(timestamp[0]) + 1)
-                if timestamp[0] == '24':
-                    timestamp[0] = '00'
-            timestamp = ':'.join(timestamp[:2])
-            timestamp = '2012-12-12 ' + timestamp + ':00'  # Need date in correct format to sort
-            all_timestamps_copy[index] = timestamp  # Overwrite and make to datetime object
+def text_frequency_full_figure(table):
+    # Only get day, ignore time
+    counts, labels = aggregate(table, 'day')
+    labels = [label.strftime('%Y-%m-%d') for label in labels]
+    return {'data': user_bars(table, counts, labels), 'layout': bar_layout('Text stats', 'Texts')}
 
-    data = []
-    for user in set(all_users):
-        all_timestamps_fixed = []
-        all_texts_fixed = []
-        for timestamp in unique(all_timestamps_copy):
-            amount_of_texts = 0
-            indices = [i for i, x in enumerate(all_timestamps_copy) if x == timestamp]
-            all_timestamps_fixed.append(timestamp)
-            for index in indices:
-                if user in all_users[index]:
-                    amount_of_texts += 1
-            all_texts_fixed.append(amount_of_texts)
-        bar_object = go.Bar(x=all_timestamps_fixed,
-                            y=all_texts_fixed,
-                            name=user)
-        data.append(bar_object)
-    layout = go.Layout(barmode='stack',
-                       title='Text stats',
-                       width=plot_width,
-                       height=plot_height,
-                       titlefont=dict(
-                           size=26),
-                       yaxis=dict(title='Texts')
-                       )
-    fig = go.Figure(data=data, layout=layout)
-    plotly.offline.plot(fig, filename='results/texts_stats_hour.html', auto_open=False)
-
-
-
-def plot_pie_chart(all_texts, all_users):
-
-    # Message count per user
-    labels = []
-    values_messages = []
-    values_word_count = []
-    for user in set(all_users):
-        labels.append(user)
-        values_messages.append(all_users.count(user))
-
-        words_user = 0
-        for index, u in enumerate(all_users):
-            if u == user:
-                words_user += len(all_texts[index].split(' '))
-        values_word_count.append(words_user)
+def text_frequency_day_figure(table):
+    counts, labels = aggregate(table, 'weekday')
+    return {'data': user_bars(table, counts, labels), 'layout': bar_layout('Text stats', 'Texts')}
+
+def text_frequency_hour_figure(table):
+    counts, labels = aggregate(table, 'half_hour')
+    return {'data': user_bars(table, counts, labels), 'layout': bar_layout('Text stats', 'Texts')}
+
+def reply_time_figure(table, flow):
+    labels = reply_labels(flow['edges'])
+    layout = bar_layout('Reply times', 'Replies')
+    layout['barmode'] = 'group'
+    return {'data': user_bars(table, flow['reply_histograms'], labels), 'layout': layout}
+
+def session_figure(table, flow):
+    # Who writes first after a gap of session_gap
+    data = [{'type': 'bar', 'x': list(table.users), 'y': flow['session_starts'].tolist(), 'name': 'Started'}]
+    return {'data': data, 'layout': bar_layout('Who starts the conversation', 'Conversations')}
+
+def media_figure(table):
+    return {'data': user_bars(table, user_totals(table)['media'], list(media_types)),
+            'layout': bar_layout('Attachments', 'Sent')}
+
+def media_month_figure(table):
+    # Every kind summed over the users, stacked per month
+    counts, labels = aggregate(table, 'month', table.media)
+    counts = counts.sum(axis=0).astype(np.int64)  # months x kinds
+    data = [{'type': 'bar', 'x': labels, 'y': counts[:, number].tolist(), 'name': kind}
+            for number, kind in enumerate(media_types)]
+    return {'data': data, 'layout': bar_layout('Attachments per month', 'Sent')}
+
+def call_figure(table):
+    counts, labels = aggregate(table, 'month', table.call_times)
+    return {'data': user_bars(table, counts.round(2), labels), 'layout': bar_layout('Calls', 'Minutes')}
+
+def pie_chart_figure(table):
+    # Message and word count per user
+    labels = table.users
+    totals = user_totals(table)
+    values_messages = totals['messages'].tolist()
+    values_word_count = totals['words'].tolist()
 
     data = [{
             "values": values_messages,
@@ -452,26 +1567,128 @@ def plot_pie_chart(all_texts, all_users):
             "hole": .4,
             "type": "pie"
             }]
-    layout = go.Layout(title='Piecharts',
-                       width=plot_width,
-                       height=plot_height,
-                       titlefont=dict(size=26),
-                       yaxis=dict(title='Texts'),
-                       annotations=[{"showarrow": False,
-                                    "text": "Messages",
-                                    "x": 0.20,
-                                    "y": 0.5},
-                                    {
-                                    "showarrow": False,
-                                    "text": "Words",
-                                    "x": 0.8,
-                                    "y": 0.5
-                                    }]
-                       )
-    fig = go.Figure(data=data, layout=layout)
-    plotly.offline.plot(fig, filename='results/piechart.html', auto_open=False)
+    layout = {'title': 'Piecharts',
+              'width': plot_width,
+              'height': plot_height,
+              'titlefont': {'size': 26},
+              'yaxis': {'title': 'Texts'},
+              'annotations': [{"showarrow": False,
+                               "text": "Messages",
+                               "x": 0.20,
+                               "y": 0.5},
+                              {
+                               "showarrow": False,
+                               "text": "Words",
+                               "x": 0.8,
+                               "y": 0.5
+                              }]}
+    return {'data': data, 'layout': layout}
 
-if __name__ == "__main__":
+def save_figure(figure, filename):
+    """One standalone html file per figure, every file has its own copy of plotly.js"""
+    import plotly
+    plotly.offline.plot(figure, filename=filename, auto_open=False)
+
+@timed
+def plot_emoji_stats(emoji_dict, most_used_emojis):
+    save_figure(emoji_figure(emoji_dict, most_used_emojis), 'results/emoji_stats.html')
+
+@timed
+def plot_text_frequency_full(table):
+    save_figure(text_frequency_full_figure(table), 'results/texts_stats_full.html')
+
+@timed
+def plot_text_frequency_day(table):
+    save_figure(text_frequency_day_figure(table), 'results/texts_stats_day.html')
+
+@timed
+def plot_text_frequency_hour(table):
+    save_figure(text_frequency_hour_figure(table), 'results/texts_stats_hour.html')
+
+@timed
+def plot_reply_times(table, flow):
+    save_figure(reply_time_figure(table, flow), 'results/reply_times.html')
+
+@timed
+def plot_sessions(table, flow):
+    save_figure(session_figure(table, flow), 'results/sessions.html')
+
+@timed
+def plot_media(table):
+    save_figure(media_figure(table), 'results/attachments.html')
+
+@timed
+def plot_media_month(table):
+    save_figure(media_month_figure(table), 'results/attachments_month.html')
+
+@timed
+def plot_calls(table):
+    save_figure(call_figure(table), 'results/calls.html')
+
+@timed
+def plot_pie_chart(table):
+    save_figure(pie_chart_figure(table), 'results/piechart.html')
+
+def report_figures(table, emoji_dict, most_used_emojis, flow):
+    """Every figure of the report as (name, function, args), in the order they are shown"""
+    return [('emoji_stats', emoji_figure, (emoji_dict, most_used_emojis)),
+            ('texts_stats_full', text_frequency_full_figure, (table,)),
+            ('texts_stats_day', text_frequency_day_figure, (table,)),
+            ('texts_stats_hour', text_frequency_hour_figure, (table,)),
+            ('reply_times', reply_time_figure, (table, flow)),
+            ('sessions', session_figure, (table, flow)),
+            ('attachments', media_figure, (table,)),
+            ('attachments_month', media_month_figure, (table,)),
+            ('calls', call_figure, (table,)),
+            ('piechart', pie_chart_figure, (table,))]
+
+@timed
+def render_report(figures, summary, filename='results/report.html', plotlyjs='inline', workers=None):
+    """
+    # Problem: Every plot_* writes its own html file with a full copy of plotly.js, several MB each
+    # Solution: All figures and the text stats in one file from templates/combined_template.html,
+    #           plotly.js is included once and the figures are compact json drawn by the browser
+    figures = list of (name, function, args) like report_figures gives, built in a thread pool
+    summary = lines of text stats
+    plotlyjs = 'inline' (file works offline) or 'cdn' (small file, plotly.js is downloaded when opened)
+    """
+    import concurrent.futures
+    import html
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        futures = [pool.submit(function, *args) for _, function, args in figures]
+        # Compact json, ensure_ascii=False keeps the emojis as they are
+        figure_json = [json.dumps(future.result(), separators=(',', ':'), ensure_ascii=False)
+                       for future in futures]
+
+    if plotlyjs == 'inline':
+        import plotly
+        script = f'<script type="text/javascript">{plotly.offline.get_plotlyjs()}</script>'
+    elif plotlyjs == 'cdn':
+        script = f'<script src="{plotlyjs_cdn}"></script>'
+    else:
+        raise ValueError(f'plotlyjs should be inline or cdn, not {plotlyjs}')
+
+    divs = ''.join(f'<div id="{name}"></div>' for name, _, _ in figures)
+    # </ in a text would end the script tag
+    figure_array = '[' + ','.join(figure_json).replace('</', '<\\/') + ']'
+    names = json.dumps([name for name, _, _ in figures])
+    plots = (f'{script}\n{divs}\n<script type="text/javascript">\n'
+             f'var figures = {figure_array};\n'
+             f'{names}.forEach(function(name, i) {{ Plotly.newPlot(name, figures[i].data, figures[i].layout); }});\n'
+             '</script>')
+    text_stats = '\n'.join(f'<p>{html.escape(line)}</p>' for line in summary)
+
+    with open(template_file, 'r', encoding='utf-8') as file:
+        contents = file.read()
+    # Plots last, a user name in the figure json could be REPLACE1
+    contents = contents.replace('REPLACE1', text_stats, 1).replace('REPLACE2', plots, 1)
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+    with open(filename, 'w', encoding='utf-8', errors='surrogatepass') as file:
+        file.write(contents)
+    return filename
+
+def choose_file():
     import tkinter
     from tkinter.filedialog import askopenfilename
     root = tkinter.Tk()
@@ -482,36 +1699,279 @@ if __name__ == "__main__":
     if filename == "":
         print('Nothing choosen. Quitting program')
         quit()
-    all_texts, all_users, all_timestamps, total_call_time = get_messages(filename)
+    return filename
+
+def find_conversations(path):
+    """Directory -> every message.html (or json export) below it, anything else is used as a glob
+    Sorted, so output order does not depend on the file system
+    A part of a split json conversation is left out if an earlier part is found, export_files reads it from there"""
+    if os.path.isdir(path):
+        return sorted(filename for name in ('message.html', 'message.json', 'message_1.json')
+                      for filename in glob.glob(os.path.join(path, '**', name), recursive=True))
+    filenames = sorted(filename for filename in glob.glob(path, recursive=True) if os.path.isfile(filename))
+    later_parts = set()
+    for filename in filenames:
+        if re.fullmatch(r'message_(\d+)\.json', os.path.basename(filename)):
+            later_parts.update(os.path.normpath(part) for part in export_files(filename)[1:])
+    return [filename for filename in filenames if os.path.normpath(filename) not in later_parts]
+
+def conversation_stats(filename, use_cache=True, refresh=False, capacity=word_capacity, gap=session_gap):
+    """Worker for run_batch, parses one conversation and returns its stats in a picklable dict
+    capacity = SpaceSaving capacity for the word stats
+    gap = seconds without messages that start a new session"""
+    stage_times_before = dict(stage_times)
+    if use_cache:
+        table = load_table_cached(filename, refresh, max_size=None)  # run_batch evicts when done
+    else:
+        table = load_table(filename)
+    emoji_dict, most_used_emojis = emoji_stats(table)
+    total_summaries, user_summaries = word_stats(table, capacity=capacity)
+    flow = flow_stats(table, gap)
+
+    totals = user_totals(table)
+    messages, words, media, reactions = totals['messages'], totals['words'], totals['media'], totals['reactions']
+    users = {}
+    for code, user in sorted(enumerate(table.users), key=lambda item: item[1]):
+        users[user] = {'messages': int(messages[code]), 'words': int(words[code]),
+                       'reactions': int(reactions[code]),
+                       'attachments': dict(zip(media_types, media[code].tolist())),
+                       'sessions_started': int(flow['session_starts'][code]),
+                       'reply_times': flow['reply_histograms'][code].tolist()}
+
+    return {'filename': filename,
+            'thread': os.path.basename(os.path.dirname(filename)),
+            'messages': len(table),
+            'words': count_words(table),
+            'call_time': table.total_call_time(),
+            'first': format_timestamp(table.local_times[-1]) if len(table) else None,
+            'last': format_timestamp(table.local_times[0]) if len(table) else None,
+            'sessions': flow['sessions'],
+            'longest_streak': flow['streak'],
+            'users': users,
+            'emojis': emoji_dict,
+            'top_words': {n: summary.top() for n, summary in total_summaries.items()},
+            # Summaries to merge, run_batch removes them before the stats are saved
+            'word_summaries': (total_summaries, user_summaries),
+            # Timers of the worker process, run_batch adds them to its own
+            'stages': {name: seconds - stage_times_before.get(name, 0) for name, seconds in stage_times.items()}}
+
+def quiet_worker(language=None):
+    """Pool initializer, progress from many workers at once is unreadable"""
+    global show_progress, export_language
+    show_progress = False
+    export_language = language or export_language
+
+def run_batch(path, workers=None, use_cache=True, refresh=False, max_size=cache_max_size, capacity=word_capacity,
+              gap=session_gap):
+    """
+    # Problem: A full data dump has thousands of conversations, one core is slow
+    # Solution: Parse every conversation in a process pool and merge the stats
+    Results come back in filename order whatever the worker count
+    """
+    import multiprocessing
+
+    filenames = find_conversations(path)
+    logging.info(f'Batch of {len(filenames)} conversations, {workers} workers')
+    if not filenames:
+        print(f'No conversations found in {path}')
+        return None
+
+    threads = []
+    global_users = {}
+    global_stats = {'conversations': 0, 'messages': 0, 'words': 0, 'call_time': 0}
+    global_summaries = {n: SpaceSaving(capacity) for n in word_ngrams}
+    user_summaries = {}
+    progress = ProgressReporter(len(filenames), 'conversations', check_every=1)
+    with multiprocessing.Pool(workers, initializer=quiet_worker, initargs=(export_language,)) as pool:
+        # imap keeps input order, so merging is deterministic
+        worker = functools.partial(conversation_stats, use_cache=use_cache, refresh=refresh, capacity=capacity,
+                                   gap=gap)
+        for stats in pool.imap(worker, filenames):
+            for name, seconds in stats.pop('stages').items():
+                add_stage_time(name, seconds)
+            thread_summaries, thread_user_summaries = stats.pop('word_summaries')
+            for n, summary in thread_summaries.items():
+                global_summaries[n] = global_summaries[n].merge(summary)
+            for user, summaries in thread_user_summaries.items():
+                if user not in user_summaries:
+                    user_summaries[user] = summaries
+                else:
+                    user_summaries[user] = {n: user_summaries[user][n].merge(summary) for n, summary in summaries.items()}
+            counters['messages'] += stats['messages']
+            threads.append(stats)
+            global_stats['conversations'] += 1
+            for key in ('messages', 'words', 'call_time'):
+                global_stats[key] += stats[key]
+            for user, user_stats in stats['users'].items():
+                if user not in global_users:
+                    global_users[user] = {'messages': 0, 'words': 0, 'reactions': 0, 'sessions_started': 0,
+                                          'attachments': dict.fromkeys(media_types, 0),
+                                          'reply_times': [0] * len(reply_edges), 'emojis': {}}
+                for key in ('messages', 'words', 'reactions', 'sessions_started'):
+                    global_users[user][key] += user_stats[key]
+                for kind, count in user_stats['attachments'].items():
+                    global_users[user]['attachments'][kind] += count
+                # Same buckets in every conversation, so the histograms add up
+                global_users[user]['reply_times'] = [total + count for total, count in
+                                                     zip(global_users[user]['reply_times'], user_stats['reply_times'])]
+            for user, emojis in stats['emojis'].items():
+                for emoji, amount in emojis.items():
+                    global_users[user]['emojis'][emoji] = global_users[user]['emojis'].get(emoji, 0) + amount
+            progress.update()
+    progress.close()
+
+    if use_cache:
+        evict_cache(max_size)
+
+    for user, summaries in user_summaries.items():
+        global_users[user]['top_words'] = {n: summary.top() for n, summary in summaries.items()}
+    for user_stats in global_users.values():
+        user_stats['median_reply_seconds'] = histogram_quantile(user_stats['reply_times'], reply_edges, 0.5)
+    global_stats['reply_time_edges'] = reply_edges.tolist()
+    global_stats['top_words'] = {n: summary.top() for n, summary in global_summaries.items()}
+    global_stats['users'] = {user: global_users[user] for user in sorted(global_users)}
+    return {'global': global_stats, 'threads': threads}
+
+def summary_lines(table):
+    """The text stats, printed and put in the report"""
+    amount_of_words = count_words(table)
+    first_timestamp = format_timestamp(table.local_times[-1])
+    delta_days = (datetime.datetime.now() - datetime.datetime.strptime(first_timestamp.split(' ')[0], "%Y-%m-%d")).days
+    return ["You have been in touch since: {}  which is  {}  days from today".format(first_timestamp, delta_days),
+            "You have sent: {} messages".format(len(table)),
+            "Average messages per day: {}".format(round(len(table)/delta_days)),
+            "Total word count: {}".format(amount_of_words),
+            "Average word count per message: {}".format(round((amount_of_words/len(table)), 2)),
+            "You have called for: {} minutes".format(round(table.total_call_time(), 2))]
+
+def main(args):
+    """The script, args from the command line"""
+    max_size = args.cache_size * 1024**2
+
+    if args.batch:
+        batch_stats = run_batch(args.path, args.workers, not args.no_cache, args.refresh_cache, max_size,
+                                args.word_capacity, args.session_gap * 60)
+        if batch_stats is None:
+            return
+        os.makedirs('results', exist_ok=True)
+        with open('results/batch_stats.json', 'w', encoding='utf-8') as outfile:
+            json.dump(batch_stats, outfile, ensure_ascii=False, indent=1)
+        global_stats = batch_stats['global']
+        print("Conversations: {}".format(global_stats['conversations']))
+        print("Total messages: {}".format(global_stats['messages']))
+        print("Total word count: {}".format(global_stats['words']))
+        print("You have called for: {} minutes".format(round(global_stats['call_time'], 2)))
+        print('Stats saved in results/batch_stats.json')
+        return
+
+    filename = args.path
+    if filename is None:
+        filename = choose_file()
+
+    if args.incremental:
+        state = update_incremental(filename)
+        print("You have sent: {} messages".format(state['total_messages']))
+        print("Total word count: {}".format(sum(state['words'].values())))
+        print("You have called for: {} minutes".format(round(sum(state['call_time'].values()), 2)))
+        for user in sorted(state['messages']):
+            print("{}: {} messages, {} words".format(user, state['messages'][user], state['words'][user]))
+        return
+
+    if args.no_cache:
+        table = load_table(filename)
+    else:
+        table = load_table_cached(filename, args.refresh_cache, max_size)
 
     # Get data
-    emoji_dict, most_used_emojis = emoji_stats(all_texts, all_users)
+    emoji_dict, most_used_emojis = emoji_stats(table)
 
     # Use data
-    amount_of_words = count_words(all_texts)
-    delta_days = (datetime.datetime.now() - datetime.datetime.strptime(all_timestamps[-1].split(' ')[0], "%Y-%m-%d")).days
+    total_summaries, _ = word_stats(table, capacity=args.word_capacity)
+    flow = flow_stats(table, args.session_gap * 60)
+    summary = summary_lines(table) + flow_lines(table, flow) + media_lines(table) + word_lines(total_summaries)
 
     #Prints
-    print("You have been in touch since:",
-          all_timestamps[-1],
-          " which is ",
-          delta_days,
-          " days from today")
-    print("You have sent: {} messages".format(len(all_texts)))
-    print("Average messages per day: {}".format(round(len(all_texts)/delta_days),3))
-    print("Total word count: {}".format(amount_of_words))
-    print("Average word count per message: {}".format(round((amount_of_words/len(all_texts)), 2)))
-    print("You have called for: {} minutes".format(round(total_call_time, 2)))
+    for line in summary:
+        print(line)
+    if args.stats_only:
+        return  # plotly is never imported
     print('')
     print('Plotting data')
 
     # Plotting
-    plot_emoji_stats(emoji_dict, most_used_emojis)
-    plot_text_frequency_full(all_texts, all_timestamps, all_users)
-    plot_text_frequency_day(all_texts, all_timestamps, all_users)
-    plot_text_frequency_hour(all_texts, all_timestamps, all_users)
-    plot_pie_chart(all_texts, all_users)
+    os.makedirs('results', exist_ok=True)
+    if args.separate_plots:
+        plot_emoji_stats(emoji_dict, most_used_emojis)
+        plot_text_frequency_full(table)
+        plot_text_frequency_day(table)
+        plot_text_frequency_hour(table)
+        plot_reply_times(table, flow)
+        plot_sessions(table, flow)
+        plot_media(table)
+        plot_media_month(table)
+        plot_calls(table)
+        plot_pie_chart(table)
+    else:
+        report = render_report(report_figures(table, emoji_dict, most_used_emojis, flow), summary, plotlyjs=args.plotlyjs)
+        print(f'Report saved in {report}')
 
     print('DONE!!')
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Statistics for facebook message exports')
+    parser.add_argument('path', nargs='?', help='Conversation file, a file dialog is opened if not given')
+    parser.add_argument('--batch', action='store_true',
+                        help='path is a directory or glob, every conversation in it is processed')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Worker processes for --batch (default: number of cores)')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only parse messages that are new since the last --incremental run of this conversation')
+    parser.add_argument('--stats-only', action='store_true',
+                        help='Print the stats without plotting, starts faster since plotly is not imported')
+    parser.add_argument('--separate-plots', action='store_true',
+                        help='One html file per plot in results/ instead of results/report.html')
+    parser.add_argument('--plotlyjs', choices=('inline', 'cdn'), default='inline',
+                        help='inline: report works offline, cdn: much smaller report, plotly.js is downloaded when opened')
+    parser.add_argument('--no-cache', action='store_true', help='Always parse, do not use the cache')
+    parser.add_argument('--refresh-cache', action='store_true', help='Parse again and replace the cached data')
+    parser.add_argument('--cache-size', type=int, default=cache_max_size // 1024**2,
+                        help='Max cache size in MB, least recently used exports are removed above it')
+    parser.add_argument('--word-capacity', type=int, default=word_capacity,
+                        help='Words and pairs of words kept per user in the word stats, more is more exact and uses more memory')
+    parser.add_argument('--session-gap', type=int, default=session_gap // 60, metavar='MINUTES',
+                        help='Minutes without messages that end a conversation in the reply time and session stats')
+    parser.add_argument('--language', choices=export_languages, default=export_language,
+                        help='Language the export was downloaded in, decides how timestamps are read')
+    parser.add_argument('--report', default='results/run_report.json',
+                        help='Where to save the json run report with stage times and counters')
+    parser.add_argument('--profile', metavar='FILE', help='Run under cProfile and save the stats in FILE')
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help='Trace memory allocations, peak and top allocations go in the run report')
+    args = parser.parse_args()
+    if args.batch and args.path is None:
+        parser.error('--batch needs a directory or glob')
+
+    export_language = args.language
+    setup_logging()
+    extra = {'arguments': vars(args)}
+    if args.tracemalloc:
+        import tracemalloc
+        tracemalloc.start()
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    with stage('total'):
+        main(args)
 
+    if args.profile:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+        extra['profile'] = args.profile
+    if args.tracemalloc:
+        snapshot = tracemalloc.take_snapshot()
+        extra['tracemalloc'] = {'peak_bytes': tracemalloc.get_traced_memory()[1],
+                                'top': [str(statistic) for statistic in snapshot.statistics('lineno')[:20]]}
+        tracemalloc.stop()
+    write_run_report(args.report, extra)
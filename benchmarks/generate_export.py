@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Writes synthetic facebook message exports, same html structure as get_messages expects
+or the json export if the file name ends with .json
+python benchmarks/generate_export.py data/synthetic/message.html --messages 1000000"""
+import argparse
+import calendar
+import datetime
+import html
+import json
+import os
+import random
+
+month_names = ['januari', 'februari', 'mars', 'april', 'maj', 'juni', 'juli', 'augusti',
+               'september', 'oktober', 'november', 'december']  # Same as conversion/month_converter.txt
+words = ['hej', 'hur', 'mår', 'du', 'bra', 'tack', 'och', 'själv', 'ja', 'nej', 'kanske', 'imorgon',
+         'idag', 'haha', 'ok', 'vi', 'ses', 'sen', 'jobbet', 'maten', 'var', 'god', 'lol', 'precis']
+reactions = ['👍', '❤', '😆', '😮', '😢', '😠']
+emojis = [':)', ':D', '<3', ':(', 'xD', ';)', '😂', '😍', '👍', '👍🏽', '❤️', '🇸🇪', '👨‍👩‍👧', '🎉']
+first_names = ['Anna', 'Bo', 'Cecilia', 'David', 'Eva', 'Fredrik', 'Greta', 'Hans', 'Ida', 'Johan']
+last_names = ['Andersson', 'Berg', 'Carlsson', 'Dahl', 'Eriksson', 'Falk', 'Gustafsson', 'Holm']
+attachments = ['<div><a href="messages/photos/{n}.jpg"><img src="messages/photos/{n}.jpg" /></a></div>',
+               '<div><a href="messages/videos/{n}.mp4"><video src="messages/videos/{n}.mp4"></video></a></div>',
+               '<div><img src="messages/stickers_used/{n}.png" /></div>',
+               '<div><a href="https://example.com/{n}">https://example.com/{n}</a></div>']
+
+message_template = ('<div class="pam _3-95 _2pi0 _2lej uiBoxWhite noborder">'
+                    '<div class="_3-96 _2pio _2lek _2lel">{user}</div>'
+                    '<div class="_3-96 _2let"><div><div></div><div>{text}</div>{extra}<div></div><div>{reactions}</div></div></div>'
+                    '<div class="_3-94 _2lem">{timestamp}</div></div>\n')
+# Same attachments in the json export
+json_attachments = [lambda n: {'photos': [{'uri': f'messages/photos/{n}.jpg'}]},
+                    lambda n: {'videos': [{'uri': f'messages/videos/{n}.mp4'}]},
+                    lambda n: {'sticker': {'uri': f'messages/stickers_used/{n}.png'}},
+                    lambda n: {'share': {'link': f'https://example.com/{n}'}}]
+
+def mojibake(text):
+    """Like facebook writes json exports, the utf-8 bytes as latin-1 characters"""
+    return text.encode('utf-8').decode('latin-1')
+
+def generate_export(filename, messages, users=2, emoji_density=0.3, attachment_density=0.05,
+                    call_density=0.01, start='2014-01-01', end='2018-12-31', seed=0, reaction_density=0):
+    """
+    Writes messages newest first, like facebook does, one message at a time so 10M messages fit in memory
+    filename = .json gives a json export with the same messages, timestamps are taken as UTC
+    users = participants in the conversation
+    emoji_density, attachment_density, call_density, reaction_density = share of messages with an emoji,
+    attachment, call or reactions
+    start, end = date span of the conversation
+    """
+    rnd = random.Random(seed)
+    names = [f'{first_names[i % len(first_names)]} {last_names[i // len(first_names) % len(last_names)]}'
+             for i in range(users)]
+    start = datetime.datetime.strptime(start, '%Y-%m-%d')
+    end = datetime.datetime.strptime(end, '%Y-%m-%d')
+    mean_gap = (end - start).total_seconds() / max(messages, 1)
+
+    folder = os.path.dirname(filename)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    as_json = filename.lower().endswith('.json')
+    with open(filename, 'w', encoding='utf-8') as file:
+        if as_json:
+            participants = json.dumps([{'name': mojibake(name)} for name in names])
+            file.write(f'{{\n  "participants": {participants},\n  "messages": [\n')
+        else:
+            file.write('<!DOCTYPE html><html><head><meta charset="UTF-8" /><title>Synthetic</title></head>'
+                       '<body class="_5vb_ _2yq _4yic"><div class="clearfix _ikh"><div class="_4bl9">'
+                       '<div class="_li"><div class="_3a_u"><div class="_4t5n" role="main">\n')
+        time_cursor = end
+        for number in range(messages):
+            time_cursor = max(time_cursor - datetime.timedelta(seconds=rnd.expovariate(1 / mean_gap)), start)
+            user = rnd.choice(names)
+            extra = ''
+            message = {'sender_name': mojibake(user),
+                       'timestamp_ms': calendar.timegm(time_cursor.replace(second=0, microsecond=0).timetuple()) * 1000,
+                       'type': 'Generic'}
+            if rnd.random() < call_density:
+                text = f'{user} ringde dig.'
+                if rnd.random() < 0.5:
+                    seconds = rnd.randint(1, 59)
+                    extra = f'<span class="_idm">Längd: {seconds} sekunder</span>'
+                else:
+                    seconds = rnd.randint(1, 120) * 60
+                    extra = f'<span class="_idm">Längd: {seconds // 60} minuter</span>'
+                message.update(type='Call', call_duration=seconds)
+            else:
+                text = ' '.join(rnd.choice(words) for _ in range(rnd.randint(1, 15)))
+                if rnd.random() < emoji_density:
+                    text += ' ' + rnd.choice(emojis)
+                if rnd.random() < attachment_density:
+                    kind = rnd.randrange(len(attachments))
+                    extra = attachments[kind].format(n=number)
+                    message.update(json_attachments[kind](number))
+            message['content'] = mojibake(text)
+            reaction_list = ''
+            if reaction_density and rnd.random() < reaction_density:  # No draw at 0, older exports stay the same
+                picked = [(rnd.choice(reactions), actor) for actor in rnd.sample(names, rnd.randint(1, len(names)))]
+                message['reactions'] = [{'reaction': mojibake(reaction), 'actor': mojibake(actor)}
+                                        for reaction, actor in picked]
+                reaction_list = ('<ul class="_tqp">' +
+                                 ''.join(f'<li>{reaction}{html.escape(actor)}</li>' for reaction, actor in picked) +
+                                 '</ul>')
+            if as_json:
+                file.write(('    ' if number == 0 else ',\n    ') + json.dumps(message))
+                continue
+            timestamp = (f'den {time_cursor.day} {month_names[time_cursor.month - 1]} {time_cursor.year} '
+                         f'{time_cursor.hour:02d}:{time_cursor.minute:02d}')
+            file.write(message_template.format(user=html.escape(user), text=html.escape(text),
+                                               extra=extra, reactions=reaction_list, timestamp=timestamp))
+        if as_json:
+            file.write('\n  ],\n  "title": "Synthetic",\n  "thread_path": "inbox/synthetic"\n}\n')
+        else:
+            file.write('</div></div></div></div></div></body></html>\n')
+    return filename
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Write a synthetic facebook message export')
+    parser.add_argument('filename', help='Where to write the export')
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--users', type=int, default=2)
+    parser.add_argument('--emoji-density', type=float, default=0.3)
+    parser.add_argument('--attachment-density', type=float, default=0.05)
+    parser.add_argument('--call-density', type=float, default=0.01)
+    parser.add_argument('--reaction-density', type=float, default=0)
+    parser.add_argument('--start', default='2014-01-01', help='First day, YYYY-MM-DD')
+    parser.add_argument('--end', default='2018-12-31', help='Last day, YYYY-MM-DD')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    generate_export(args.filename, args.messages, args.users, args.emoji_density, args.attachment_density,
+                    args.call_density, args.start, args.end, args.seed, args.reaction_density)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Times every stage of the pipeline on synthetic exports and saves the results as json
+python benchmarks/run_benchmarks.py --sizes 1000 100000 1000000"""
+from lxml import etree
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Create_stats_quickfix as stats
+from generate_export import generate_export
+
+def peak_rss():
+    """Peak resident memory of the whole process so far in bytes, None if it can not be measured"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024  # Linux gives kB
+
+def run_stage(results, name, function, *args):
+    """
+    Times one stage and, while tracemalloc is tracing, the most memory it had allocated at once
+    peak_memory is counted from the start of the stage, so every stage shows its own peak.
+    Memory libxml2 allocates itself is not seen by tracemalloc
+    Tracing makes every stage slower by a different amount, so seconds only count from an untraced pass
+    """
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    value = function(*args)
+    seconds = time.perf_counter() - start
+    peak_memory = tracemalloc.get_traced_memory()[1] - before if tracing else None
+    results[name] = {'seconds': round(seconds, 4), 'peak_memory': peak_memory}
+    print(f'  {name}: {results[name]["seconds"]} s' +
+          (f', {peak_memory / 1024**2:.1f} MB' if peak_memory is not None else ''))
+    return value
+
+def raw_fields(filename):
+    """Texts and timestamps before text_cleaner and timestamp parsing, so they can be timed on their own"""
+    texts = []
+    timestamps = []
+    for _, element in etree.iterparse(filename, events=('end',), tag='div', html=True, huge_tree=True):
+        if element.get('class') != stats.message_class:
+            continue
+        texts.append(stats.element_text(element.find(f'.//div[@class="{stats.text_class}"]')))
+        timestamps.append(stats.element_text(element.find(f'.//div[@class="{stats.timestamp_class}"]')))
+        # Like iter_messages, the parsed tree never grows past one message
+        element.clear(keep_tail=True)
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+    return texts, timestamps
+
+def benchmark(filename, json_filename):
+    """Every stage on one export (html and the same messages as json), returns {stage: {'seconds', 'peak_memory'}}"""
+    results = {}
+    table = run_stage(results, 'parse', stats.load_table, filename)
+    texts, timestamps = raw_fields(filename)
+    conversions = stats.load_conversion_tables()
+    run_stage(results, 'text_cleaner', lambda: [stats.text_cleaner(text, conversions) for text in texts])
+    run_stage(results, 'timestamp_fixer',
+              lambda: [stats.timestamp_fixer(timestamp, conversions['month_converter']) for timestamp in timestamps])
+    run_stage(results, 'parse_timestamps', stats.parse_timestamps, timestamps)
+    del texts, timestamps
+    emoji_dict, most_used_emojis = run_stage(results, 'emoji_stats', stats.emoji_stats, table)
+    run_stage(results, 'plot_emoji_stats', stats.plot_emoji_stats, emoji_dict, most_used_emojis)
+    run_stage(results, 'plot_text_frequency_full', stats.plot_text_frequency_full, table)
+    run_stage(results, 'plot_text_frequency_day', stats.plot_text_frequency_day, table)
+    run_stage(results, 'plot_text_frequency_hour', stats.plot_text_frequency_hour, table)
+    flow = run_stage(results, 'flow_stats', stats.flow_stats, table)
+    run_stage(results, 'plot_reply_times', stats.plot_reply_times, table, flow)
+    run_stage(results, 'plot_sessions', stats.plot_sessions, table, flow)
+    run_stage(results, 'plot_media', stats.plot_media, table)
+    run_stage(results, 'plot_media_month', stats.plot_media_month, table)
+    run_stage(results, 'plot_calls', stats.plot_calls, table)
+    run_stage(results, 'plot_pie_chart', stats.plot_pie_chart, table)
+    run_stage(results, 'render_report', stats.render_report,
+              stats.report_figures(table, emoji_dict, most_used_emojis, flow), stats.summary_lines(table))
+    run_stage(results, 'parse_json', stats.load_table, json_filename)
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark every stage on synthetic exports')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='Messages per generated export, 1k to 10M')
+    parser.add_argument('--users', type=int, default=2)
+    parser.add_argument('--emoji-density', type=float, default=0.3)
+    parser.add_argument('--attachment-density', type=float, default=0.05)
+    parser.add_argument('--call-density', type=float, default=0.01)
+    parser.add_argument('--reaction-density', type=float, default=0.05)
+    parser.add_argument('--start', default='2014-01-01')
+    parser.add_argument('--end', default='2018-12-31')
+    parser.add_argument('--output', default=None, help='Results json, default benchmarks/results/<date>.json')
+    parser.add_argument('--memory', action='store_true',
+                        help='Also measure peak memory per stage, in a second pass with tracemalloc')
+    args = parser.parse_args()
+
+    output = args.output
+    if output is None:
+        output = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results',
+                              datetime.datetime.now().strftime('%Y-%m-%d_%H%M%S') + '.json')
+    report = {'date': datetime.datetime.now().isoformat(timespec='seconds'),
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'settings': vars(args),
+              'runs': []}
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        os.makedirs(os.path.join(work_dir, 'results'))
+        os.chdir(work_dir)  # Plots are written to results/
+        for size in args.sizes:
+            filename = os.path.join(work_dir, f'message_{size}.html')
+            print(f'Generating {size} messages')
+            generate_export(filename, size, args.users, args.emoji_density, args.attachment_density,
+                            args.call_density, args.start, args.end, reaction_density=args.reaction_density)
+            # Same messages as a json export, for the other parser
+            json_filename = os.path.join(work_dir, f'message_{size}.json')
+            generate_export(json_filename, size, args.users, args.emoji_density, args.attachment_density,
+                            args.call_density, args.start, args.end, reaction_density=args.reaction_density)
+            stages = benchmark(filename, json_filename)
+            if args.memory:
+                print('Measuring memory')
+                tracemalloc.start()
+                traced = benchmark(filename, json_filename)
+                tracemalloc.stop()
+                for name, result in stages.items():
+                    result['peak_memory'] = traced[name]['peak_memory']
+            report['runs'].append({'messages': size,
+                                   'file_size': os.path.getsize(filename),
+                                   'json_file_size': os.path.getsize(json_filename),
+                                   'peak_rss': peak_rss(),  # Whole process, all sizes so far
+                                   'stages': stages})
+            os.remove(filename)
+            os.remove(json_filename)
+
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as file:
+        json.dump(report, file, indent=1)
+    print(f'Results saved in {output}')
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Measures how long importing Create_stats_quickfix takes and checks that the slow libraries stay lazy
+Exits with 1 if the import is slower than --max-ms or a lazy library is imported too early
+python benchmarks/startup_benchmark.py --max-ms 300"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from generate_export import generate_export
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+script = os.path.join(repo_dir, 'Create_stats_quickfix.py')
+# Imported where they are used, never at import time
+lazy_modules = ('bs4', 'emoji', 'plotly', 'matplotlib', 'seaborn', 'pdb', 'multiprocessing')
+# Never imported by --stats-only
+plotting_modules = ('plotly', 'matplotlib', 'seaborn')
+
+def run_python(code, cwd=repo_dir):
+    """Runs code in a fresh interpreter, returns stdout and stderr"""
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=cwd,
+                             capture_output=True, text=True, encoding='utf-8')
+    if process.returncode != 0:
+        raise RuntimeError(process.stderr)
+    return process.stdout, process.stderr
+
+def import_time(importtime_output, module='Create_stats_quickfix'):
+    """Cumulative import time of module in seconds, from the -X importtime output"""
+    for line in importtime_output.splitlines():
+        if line.startswith('import time:') and line.split('|')[-1].strip() == module:
+            return int(line.split('|')[1]) / 1e6
+    raise ValueError(f'{module} not in the -X importtime output')
+
+def loaded(modules_json, names):
+    """The names that were imported, modules_json = json list of sys.modules"""
+    modules = {module.split('.')[0] for module in json.loads(modules_json)}
+    return sorted(name for name in names if name in modules)
+
+def measure_import(repeat):
+    """Median import time over repeat runs, and the lazy modules the import loaded"""
+    code = 'import sys, json; import Create_stats_quickfix; print(json.dumps(list(sys.modules)))'
+    times = []
+    for _ in range(repeat):
+        stdout, stderr = run_python(code)
+        times.append(import_time(stderr))
+    return statistics.median(times), loaded(stdout, lazy_modules)
+
+def measure_stats_only(messages):
+    """Total time of a --stats-only run on a generated export, and the plotting modules it loaded"""
+    with tempfile.TemporaryDirectory() as work_dir:
+        filename = os.path.join(work_dir, 'message.html')
+        generate_export(filename, messages)
+        code = ('import sys, json, runpy, time; start = time.perf_counter(); '
+                f'sys.argv = [{script!r}, {filename!r}, "--stats-only", "--no-cache", '
+                f'"--report", {os.path.join(work_dir, "report.json")!r}]; '
+                f'runpy.run_path({script!r}, run_name="__main__"); '
+                'print(json.dumps(list(sys.modules))); print(time.perf_counter() - start)')
+        stdout, _ = run_python(code, cwd=work_dir)
+    lines = stdout.strip().splitlines()
+    return float(lines[-1]), loaded(lines[-2], plotting_modules)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Import time and lazy import guard')
+    parser.add_argument('--repeat', type=int, default=5, help='Imports to take the median of')
+    parser.add_argument('--max-ms', type=float, default=300, help='Fail if the import takes longer')
+    parser.add_argument('--messages', type=int, default=1000, help='Size of the export for the --stats-only run')
+    args = parser.parse_args()
+
+    failed = False
+    seconds, modules = measure_import(args.repeat)
+    print(f'import Create_stats_quickfix: {round(seconds * 1000, 1)} ms (median of {args.repeat})')
+    if seconds * 1000 > args.max_ms:
+        print(f'  FAIL: slower than {args.max_ms} ms')
+        failed = True
+    if modules:
+        print(f'  FAIL: imported at startup: {", ".join(modules)}')
+        failed = True
+
+    seconds, modules = measure_stats_only(args.messages)
+    print(f'--stats-only on {args.messages} messages: {round(seconds, 3)} s')
+    if modules:
+        print(f'  FAIL: --stats-only imported {", ".join(modules)}')
+        failed = True
+    sys.exit(1 if failed else 0)
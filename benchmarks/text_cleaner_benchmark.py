@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Micro-benchmark of text_cleaner, per message cost before and after the single pass cleaner
+python benchmarks/text_cleaner_benchmark.py --messages 1000000"""
+from bs4 import BeautifulSoup
+import argparse
+import random
+import time
+import warnings
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Create_stats_quickfix as stats
+
+words = ['hej', 'hur', 'mår', 'du', 'bra', 'tack', 'och', 'själv', 'ja', 'nej', 'kanske',
+         'imorgon', 'haha', 'ok', 'https://example.com', 'a', '1', '<', '>']
+smileys = [':)', ':D', '<3', ':(', 'xD', ':-))', '0:)', ';)', '😂', '👍']
+bad_chars = ['\U000fe32b', '\U000fe338', '\U000feb17', '❤']
+tags = ['<a href="https://example.com">link</a>', '<img src="photos/1.jpg">',
+        '<img src="stickers/1.png"/>', '<p>', '</p>', '<b>bold</b>']
+
+def synthetic_texts(amount, seed=1):
+    """Message texts looking like the ones find_text gives"""
+    rnd = random.Random(seed)
+    texts = []
+    for _ in range(amount):
+        text = [rnd.choice(words) for _ in range(rnd.randint(1, 15))]
+        if rnd.random() < 0.3:
+            text.append(rnd.choice(smileys))
+        if rnd.random() < 0.05:
+            text.append(rnd.choice(bad_chars))
+        if rnd.random() < 0.05:
+            text.append(rnd.choice(tags))
+        texts.append(' '.join(text))
+    return texts
+
+def text_cleaner_reference(text, char_dict={}, ascii_to_emoji_dict={}):
+    """text_cleaner before the single pass version, kept here to compare against"""
+    text = text.replace('<p>', '')  # Remove <p>
+    text = text.replace('</p>', '') # Remove </p>
+
+    # Check for images, videos, stickers etc
+    warnings.filterwarnings("ignore", category=UserWarning, module='bs4')  # Supress URL errors
+    if bool(BeautifulSoup(text, "html.parser").find()):
+        tags = BeautifulSoup(text, "html.parser").find_all()
+        for tag in tags:
+            text = text.replace(str(tag), '')  # Needs to make tag into string
+    else:
+        tags = ['']
+    warnings.filterwarnings("always", category=UserWarning, module='bs4')  # Restart warnings
+
+    # Fixed bugged symbols, japan/samsung
+    for char in text:
+        if char in char_dict.keys():
+            text = text.replace(char, char_dict[char])
+
+    # Fix ascii smileys to unicode
+    for ascii_emoji in ascii_to_emoji_dict.keys():
+        if ascii_emoji in text:
+            text = text.replace(ascii_emoji, ascii_to_emoji_dict[ascii_emoji])
+
+    return text, tags
+
+def time_cleaner(name, cleaner, texts):
+    start = time.perf_counter()
+    for text in texts:
+        cleaner(text)
+    total = time.perf_counter() - start
+    print(f'{name}: {total:.2f} s, {total / len(texts) * 1e6:.2f} us per message')
+    return total
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark text_cleaner')
+    parser.add_argument('--messages', type=int, default=1000000, help='Size of synthetic corpus')
+    parser.add_argument('--skip-reference', action='store_true', help='Only time the current text_cleaner')
+    args = parser.parse_args()
+
+    print(f'Generating {args.messages} messages')
+    texts = synthetic_texts(args.messages)
+    conversions = stats.load_conversion_tables()
+
+    after = time_cleaner('text_cleaner', lambda text: stats.text_cleaner(text, conversions), texts)
+    if not args.skip_reference:
+        char_dict = conversions['char_dict']
+        ascii_to_emoji_dict = conversions['ascii_to_emoji_dict']
+        warnings.showwarning = lambda *args, **kwargs: None  # Reference turns bs4 warnings back on
+        before = time_cleaner('text_cleaner (reference)',
+                              lambda text: text_cleaner_reference(text, char_dict, ascii_to_emoji_dict),
+                              texts)
+        print(f'Speedup: {before / after:.1f}x')
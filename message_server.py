@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Keeps parsed conversations in memory and answers questions about them over http
+python message_server.py data/messages --port 8000
+curl 'localhost:8000/histogram?conversation=johndoe&by=week&value=call_time&start=2018-01-01&end=2018-07-01'
+
+GET  /conversations                     loaded conversations, and the ones still loading
+GET  /stats?conversation=&start=&end=&user=
+GET  /emojis?conversation=&start=&end=&user=&top=20
+GET  /histogram?conversation=&start=&end=&user=&by=day&value=messages&kind=
+POST /load?path=                        parses new exports in the background, queries keep working
+start and end are local dates (2018-02-15 or 2018-02-15 12:40), start is included and end is not
+conversation can be left out when only one conversation is loaded
+value=attachments counts every kind of attachment, or only kind (photo, video...) if it is given"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import concurrent.futures
+import datetime
+import functools
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import urllib.parse
+import numpy as np
+import Create_stats_quickfix as stats
+
+histogram_values = {'messages': None, 'words': 'word_counts', 'call_time': 'call_times', 'reactions': 'reactions',
+                    'attachments': 'media'}
+
+class ConversationIndex:
+    """
+    # Problem: Every question about a conversation meant running the script and parsing the export again
+    # Solution: Keep the table in memory, sorted by time with one posting list per user,
+    #           so the rows of a date range are two binary searches away
+    Emojis are found once here, emoji_codes[emoji_offsets[row]:emoji_offsets[row + 1]] are the emojis of row
+    as numbers in emojis, so /emojis only counts them
+    """
+    def __init__(self, name, filename, table):
+        self.name = name
+        self.filename = filename
+        self.table = table
+        self.order = np.argsort(table.local_times, kind='stable')  # Row numbers, oldest first
+        self.times = table.local_times[self.order]
+        codes = table.user_codes[self.order]
+        self.postings = [self.order[codes == code] for code in range(len(table.users))]
+        self.posting_times = [self.times[codes == code] for code in range(len(table.users))]
+        self.user_index = {user: code for code, user in enumerate(table.users)}
+        self.emojis, self.emoji_offsets, self.emoji_codes = emoji_columns(table)
+
+    def rows(self, start=None, end=None, user=None):
+        """Row numbers of the messages from start (included) to end (not included), oldest first"""
+        rows, times = self.order, self.times
+        if user is not None:
+            if user not in self.user_index:
+                raise KeyError(f'No user {user} in {self.name}')
+            rows, times = self.postings[self.user_index[user]], self.posting_times[self.user_index[user]]
+        first = 0 if start is None else int(np.searchsorted(times, start, 'left'))
+        last = len(times) if end is None else int(np.searchsorted(times, end, 'left'))
+        return rows[first:max(first, last)]
+
+    def select(self, start=None, end=None, user=None):
+        """Table with the messages of rows(start, end, user), newest first like an export"""
+        if start is None and end is None and user is None:
+            return self.table
+        return self.table.take(self.rows(start, end, user)[::-1])
+
+def emoji_columns(table):
+    """Every emoji used, and the emojis of every row as offsets into an array of numbers in that list"""
+    emoji_index = {}
+    codes = []
+    lengths = np.zeros(len(table), dtype=np.int64)
+    for row, text in enumerate(table.texts):
+        if not text.isascii():  # Ascii smileys are already unicode after text_cleaner
+            emojis = stats.find_emojis(text)
+            codes.extend(emoji_index.setdefault(emoji, len(emoji_index)) for emoji in emojis)
+            lengths[row] = len(emojis)
+    offsets = np.zeros(len(table) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return list(emoji_index), offsets, np.array(codes, dtype=np.int32)
+
+class MessageStore:
+    """
+    Conversations by name. Exports are parsed in a worker process and put in the parse cache,
+    the server then memory-maps the cached table, so parsing never holds up the queries
+    """
+    def __init__(self, workers=1):
+        self.conversations = {}
+        self.loading = {}  # name: filename
+        self.errors = {}  # name: why loading failed
+        self.lock = threading.Lock()
+        # spawn, forking a process that runs server threads is not safe
+        self.pool = concurrent.futures.ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'),
+                                                           initializer=stats.quiet_worker,
+                                                           initargs=(stats.export_language,))
+
+    def load(self, filename, name=None):
+        """Starts loading filename in the background, the conversation keeps its old data until it is done"""
+        name = name or conversation_name(filename)
+        with self.lock:
+            self.loading[name] = filename
+        future = self.pool.submit(cache_export, filename)
+        future.add_done_callback(functools.partial(self.loaded, name, filename))
+        return name
+
+    def loaded(self, name, filename, future):
+        try:
+            future.result()
+            index = ConversationIndex(name, filename, stats.load_table_cached(filename))
+        except Exception as error:
+            logging.exception(f'Could not load {filename}')
+            with self.lock:
+                self.errors[name] = str(error)
+                self.loading.pop(name, None)
+            return
+        logging.info(f'Loaded {filename} as {name}, {len(index.table)} messages')
+        with self.lock:
+            # Queries that already have the old index finish with it
+            self.conversations[name] = index
+            self.loading.pop(name, None)
+            self.errors.pop(name, None)
+
+    def get(self, name=None):
+        with self.lock:
+            if name is None:
+                if len(self.conversations) != 1:
+                    raise ValueError(f'conversation is needed when {len(self.conversations)} conversations are loaded')
+                return next(iter(self.conversations.values()))
+            if name not in self.conversations:
+                raise KeyError(f'No conversation {name}' + (', it is still loading' if name in self.loading else ''))
+            return self.conversations[name]
+
+    def status(self):
+        with self.lock:
+            return {'conversations': {name: {'filename': index.filename,
+                                             'messages': len(index.table),
+                                             'users': index.table.users}
+                                      for name, index in sorted(self.conversations.items())},
+                    'loading': dict(self.loading),
+                    'errors': dict(self.errors)}
+
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+def cache_export(filename):
+    """Runs in the worker process, parses filename into the cache if it is not there already"""
+    return len(stats.load_table_cached(filename))
+
+def conversation_name(filename):
+    """Folder name for message.html (or message_1.json) files from a data dump, the file name otherwise"""
+    name = os.path.splitext(os.path.basename(filename))[0]
+    if name == 'message' or name.startswith('message_'):
+        name = os.path.basename(os.path.dirname(os.path.abspath(filename)))
+    return name
+
+def parse_time(value):
+    """Local date or date and time -> seconds, same scale as MessageTable.local_times"""
+    if not value:
+        return None
+    try:
+        time_obj = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f'{value} is not a date like 2018-02-15 or 2018-02-15 12:40')
+    return int((time_obj.replace(tzinfo=None) - datetime.datetime(1970, 1, 1)).total_seconds())
+
+def query_stats(table):
+    """Messages, words, call time, reactions and attachments in total and per user"""
+    totals = stats.user_totals(table)
+    messages, words, call_times = totals['messages'], totals['words'], totals['call_time']
+    reactions, media = totals['reactions'], totals['media']
+    users = {user: {'messages': int(messages[code]), 'words': int(words[code]),
+                    'call_time': round(float(call_times[code]), 2),
+                    'reactions': int(reactions[code]),
+                    'attachments': dict(zip(stats.media_types, media[code].tolist()))}
+             for code, user in enumerate(table.users) if messages[code]}
+    return {'messages': len(table),
+            'words': stats.count_words(table),
+            'call_time': round(table.total_call_time(), 2),
+            'first': stats.format_timestamp(table.local_times[-1]) if len(table) else None,
+            'last': stats.format_timestamp(table.local_times[0]) if len(table) else None,
+            'users': users}
+
+def query_emojis(index, rows, top=20):
+    """Most used emojis in rows of index, in total and per user, counted from the emojis index found when loading"""
+    starts = index.emoji_offsets[rows]
+    lengths = index.emoji_offsets[rows + 1] - starts
+    # Positions in emoji_codes of every emoji in rows, one arange per row without a python loop
+    ends = np.cumsum(lengths)
+    positions = np.arange(ends[-1] if len(ends) else 0) + np.repeat(starts - (ends - lengths), lengths)
+    users = np.repeat(index.table.user_codes[rows], lengths).astype(np.int64)
+    counts = np.bincount(users * len(index.emojis) + index.emoji_codes[positions],
+                         minlength=len(index.table.users) * len(index.emojis))
+    counts = counts.reshape(len(index.table.users), len(index.emojis))
+    total = counts.sum(axis=0)
+    most_used = [code for code in np.argsort(-total, kind='stable')[:top].tolist() if total[code]]
+    return {'emojis': {index.emojis[code]: int(total[code]) for code in most_used},
+            'users': {user: {index.emojis[code]: int(counts[user_code, code]) for code in most_used
+                             if counts[user_code, code]}
+                      for user_code, user in enumerate(index.table.users) if counts[user_code].any()}}
+
+def query_histogram(table, by='day', value='messages', kind=None):
+    """
+    Messages, words, call time, reactions or attachments per bucket and user
+    by is a bucketing in Create_stats_quickfix.bucketings, kind is one of media_types for value=attachments
+    """
+    if by not in stats.bucketings:
+        raise ValueError(f'by should be one of {", ".join(stats.bucketings)}')
+    if value not in histogram_values:
+        raise ValueError(f'value should be one of {", ".join(histogram_values)}')
+    weights = getattr(table, histogram_values[value]) if histogram_values[value] else None
+    if value == 'attachments':
+        if kind is None:
+            weights = weights.sum(axis=1)
+        elif kind in stats.media_index:
+            weights = weights[:, stats.media_index[kind]]
+        else:
+            raise ValueError(f'kind should be one of {", ".join(stats.media_types)}')
+    counts, labels = stats.aggregate(table, by, weights)
+    if by == 'day':
+        labels = [label.strftime('%Y-%m-%d') for label in labels]
+    counts = counts.round(2) if value == 'call_time' else counts.astype(np.int64)
+    return {'labels': labels,
+            'users': {user: counts[code].tolist() for code, user in enumerate(table.users)}}
+
+class QueryHandler(BaseHTTPRequestHandler):
+    store = None  # Set by serve
+    # (start, end, user) is the span of messages asked for
+    queries = {'/stats': lambda index, span, arguments: query_stats(index.select(*span)),
+               '/emojis': lambda index, span, arguments: query_emojis(index, index.rows(*span),
+                                                                      int(arguments.get('top', 20))),
+               '/histogram': lambda index, span, arguments: query_histogram(index.select(*span),
+                                                                            arguments.get('by', 'day'),
+                                                                            arguments.get('value', 'messages'),
+                                                                            arguments.get('kind'))}
+
+    def do_GET(self):
+        self.handle_query(self.answer_get)
+
+    def do_POST(self):
+        self.handle_query(self.answer_post)
+
+    def handle_query(self, answer):
+        start = time.perf_counter()
+        url = urllib.parse.urlsplit(self.path)
+        arguments = dict(urllib.parse.parse_qsl(url.query))
+        try:
+            status, body = answer(url.path, arguments)
+        except KeyError as error:
+            status, body = 404, {'error': error.args[0] if error.args else str(error)}
+        except ValueError as error:
+            status, body = 400, {'error': str(error)}
+        body['milliseconds'] = round((time.perf_counter() - start) * 1000, 2)
+        self.respond(status, body)
+
+    def answer_get(self, path, arguments):
+        if path == '/conversations':
+            return 200, self.store.status()
+        if path not in self.queries:
+            raise KeyError(f'No endpoint {path}')
+        index = self.store.get(arguments.get('conversation'))
+        span = parse_time(arguments.get('start')), parse_time(arguments.get('end')), arguments.get('user')
+        return 200, self.queries[path](index, span, arguments)
+
+    def answer_post(self, path, arguments):
+        if path != '/load':
+            raise KeyError(f'No endpoint {path}')
+        if 'path' not in arguments:
+            raise ValueError('path is needed')
+        filenames = stats.find_conversations(arguments['path'])
+        if not filenames:
+            raise KeyError(f'No conversations found in {arguments["path"]}')
+        return 202, {'loading': [self.store.load(filename) for filename in filenames]}
+
+    def respond(self, status, body):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8', 'surrogatepass')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logging.info(f'{self.address_string()} {format % args}')
+
+def serve(store, host='127.0.0.1', port=8000):
+    """Answers queries until ctrl-c"""
+    QueryHandler.store = store
+    server = ThreadingHTTPServer((host, port), QueryHandler)
+    print(f'Listening on http://{host}:{server.server_address[1]}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        store.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Query server for facebook message exports')
+    parser.add_argument('paths', nargs='*', help='Conversation files, directories or globs to load at start')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=1, help='Processes that parse new exports')
+    parser.add_argument('--language', choices=stats.export_languages, default=stats.export_language,
+                        help='Language the exports were downloaded in, decides how timestamps are read')
+    args = parser.parse_args()
+
+    stats.export_language = args.language
+    stats.setup_logging()
+    store = MessageStore(args.workers)
+    for path in args.paths:
+        for filename in stats.find_conversations(path):
+            store.load(filename)
+    serve(store, args.host, args.port)
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Full-text search over every conversation, the index is saved as .npy files and memory-mapped
+python search_index.py build data/messages
+python search_index.py query 'pizza' '"see you soon"' 'hej*' --by month --show 5
+
+A query is one or more parts that all have to be in the message:
+word = the word, "some words" = the words in that order, wor* = any word starting with wor"""
+import argparse
+import array
+import bisect
+import collections
+import itertools
+import json
+import logging
+import os
+import shutil
+import numpy as np
+import Create_stats_quickfix as stats
+
+index_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'search_index')
+index_version = 1  # Change if the tokenizer or the file format changes
+index_columns = ('term_offsets', 'posting_messages', 'posting_positions',
+                 'message_conversations', 'message_rows', 'message_users', 'message_times')
+periods = ('day', 'week', 'month', 'year')
+
+def build_index(filenames, path=index_dir):
+    """
+    # Problem: Finding messages with a word means parsing every conversation and scanning all texts
+    # Solution: Tokenize every message once while the conversations are extracted, and save an inverted
+    #           index: for every term the (message, position) of each occurrence, sorted by message.
+    #           Terms are sorted too, so a prefix is one contiguous slice of the postings
+    filenames = conversations to index, parsed through the parse cache
+    Returns the number of indexed messages
+    """
+    vocabulary = collections.defaultdict(itertools.count().__next__)  # term: id, in order of first use
+    term_ids = array.array('i')
+    messages = array.array('i')
+    positions = array.array('i')
+    message_conversations = []
+    message_rows = []
+    message_users = []
+    message_times = []
+    users = {}
+    message_count = 0
+    for conversation, filename in enumerate(filenames):
+        logging.info(f'Indexing {filename}')
+        table = stats.load_table_cached(filename)
+        for text in table.texts:
+            tokens = stats.tokenize(text)
+            term_ids.extend(map(vocabulary.__getitem__, tokens))
+            messages.extend(itertools.repeat(message_count, len(tokens)))
+            positions.extend(range(len(tokens)))
+            message_count += 1
+        user_ids = np.array([users.setdefault(user, len(users)) for user in table.users], dtype=np.int32)
+        message_conversations.append(np.full(len(table), conversation, dtype=np.int32))
+        message_rows.append(np.arange(len(table), dtype=np.int32))
+        message_users.append(user_ids[table.user_codes])
+        message_times.append(np.asarray(table.local_times))
+
+    # Renumber the terms in sorted order and group the occurrences by term, a stable sort keeps
+    # them in (message, position) order inside every term
+    terms = sorted(vocabulary, key=vocabulary.get)
+    order = sorted(range(len(terms)), key=terms.__getitem__)
+    rank = np.empty(len(terms), dtype=np.int32)
+    rank[order] = np.arange(len(terms), dtype=np.int32)
+    term_ids = rank[np.frombuffer(term_ids, dtype=np.int32)] if term_ids else np.zeros(0, dtype=np.int32)
+    occurrences = np.argsort(term_ids, kind='stable')
+    term_offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+    term_offsets[1:] = np.cumsum(np.bincount(term_ids, minlength=len(terms)))
+
+    def joined(parts, dtype):
+        return np.concatenate(parts).astype(dtype) if parts else np.zeros(0, dtype=dtype)
+
+    columns = {'term_offsets': term_offsets,
+               'posting_messages': np.frombuffer(messages, dtype=np.int32)[occurrences],
+               'posting_positions': np.frombuffer(positions, dtype=np.int32)[occurrences],
+               'message_conversations': joined(message_conversations, np.int32),
+               'message_rows': joined(message_rows, np.int32),
+               'message_users': joined(message_users, np.int32),
+               'message_times': joined(message_times, np.int64)}
+    meta = {'version': index_version,
+            'conversations': [os.path.abspath(filename) for filename in filenames],
+            'users': list(users),
+            'messages': message_count,
+            'terms': len(terms),
+            'language': stats.export_language}
+
+    # Same as the parse cache, written to a temporary folder and renamed so readers never see half an index
+    temporary_path = f'{path}.{os.getpid()}.tmp'
+    os.makedirs(temporary_path, exist_ok=True)
+    for name in index_columns:
+        np.save(os.path.join(temporary_path, f'{name}.npy'), columns[name])
+    with open(os.path.join(temporary_path, 'terms.txt'), 'w', encoding='utf-8', errors='surrogatepass', newline='') as file:
+        file.write('\n'.join(terms[term] for term in order))
+    with open(os.path.join(temporary_path, 'meta.json'), 'w', encoding='utf-8') as file:
+        json.dump(meta, file, ensure_ascii=False)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(temporary_path, path)
+    logging.info(f'Indexed {message_count} messages, {len(terms)} terms, {len(term_ids)} words')
+    return message_count
+
+class SearchIndex:
+    """The index build_index saved, columns are memory-mapped so opening it costs about nothing"""
+    def __init__(self, path=index_dir):
+        with open(os.path.join(path, 'meta.json'), 'r', encoding='utf-8') as file:
+            self.meta = json.load(file)
+        if self.meta['version'] != index_version:
+            raise ValueError(f'{path} was built by another version, build it again')
+        with open(os.path.join(path, 'terms.txt'), 'r', encoding='utf-8', errors='surrogatepass', newline='') as file:
+            contents = file.read()
+        self.terms = contents.split('\n') if contents else []  # Sorted
+        for name in index_columns:
+            setattr(self, name, np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r'))
+        self.users = self.meta['users']
+        self.conversations = self.meta['conversations']
+
+    def term_slice(self, term):
+        """Where the occurrences of term are in the postings, empty slice if it is not in the index"""
+        number = bisect.bisect_left(self.terms, term)
+        if number == len(self.terms) or self.terms[number] != term:
+            return slice(0, 0)
+        return slice(int(self.term_offsets[number]), int(self.term_offsets[number + 1]))
+
+    def term(self, word):
+        """Message ids (sorted) with word"""
+        tokens = stats.tokenize(word)
+        if len(tokens) != 1:
+            return self.phrase(word)
+        return np.unique(self.posting_messages[self.term_slice(tokens[0])])
+
+    def prefix(self, prefix):
+        """Message ids (sorted) with a word starting with prefix"""
+        prefix = prefix.lower()
+        first = bisect.bisect_left(self.terms, prefix)
+        last = bisect.bisect_left(self.terms, prefix + '\U0010ffff')
+        return np.unique(self.posting_messages[int(self.term_offsets[first]):int(self.term_offsets[last])])
+
+    def phrase(self, text):
+        """Message ids (sorted) with the words of text next to each other, in order"""
+        tokens = stats.tokenize(text)
+        if not tokens:
+            return np.zeros(0, dtype=np.int32)
+        # (message, position) as one int64 so a phrase is lookups in sorted arrays
+        candidates = None
+        for offset, token in enumerate(tokens):
+            where = self.term_slice(token)
+            keys = (self.posting_messages[where].astype(np.int64) << 32) | self.posting_positions[where]
+            if candidates is None:
+                candidates = keys
+                continue
+            wanted = candidates + offset
+            found = np.searchsorted(keys, wanted)
+            found[found == len(keys)] = 0
+            candidates = candidates[(keys[found] == wanted) if len(keys) else np.zeros(len(wanted), dtype=bool)]
+            if not len(candidates):
+                break
+        return np.unique((candidates >> 32).astype(np.int32))
+
+    def search(self, parts, user=None):
+        """Message ids (sorted) matching every part, see the module docstring for the syntax"""
+        found = None
+        for part in parts:
+            if len(part) > 1 and part.startswith('"') and part.endswith('"'):
+                messages = self.phrase(part[1:-1])
+            elif part.endswith('*'):
+                messages = self.prefix(part[:-1])
+            else:
+                messages = self.term(part)
+            found = messages if found is None else np.intersect1d(found, messages, assume_unique=True)
+        if found is None:
+            found = np.zeros(0, dtype=np.int32)
+        if user is not None:
+            if user not in self.users:
+                raise KeyError(f'No user {user} in the index')
+            found = found[self.message_users[found] == self.users.index(user)]
+        return found
+
+    def counts(self, messages, by='user'):
+        """Hits per user, or per day, week (labeled with its Monday), month or year"""
+        if by == 'user':
+            counts = np.bincount(self.message_users[messages], minlength=len(self.users))
+            return {user: int(count) for user, count in zip(self.users, counts) if count}
+        if by not in periods:
+            raise ValueError(f'by should be user or one of {", ".join(periods)}')
+        days = np.asarray(self.message_times[messages]) // 86400
+        if by == 'week':
+            buckets = (((days + 3) // 7) * 7 - 3).astype('datetime64[D]')
+        else:
+            buckets = days.astype('datetime64[D]').astype(f'datetime64[{by[0].upper()}]')
+        labels, counts = np.unique(buckets, return_counts=True)
+        return {str(label): int(count) for label, count in zip(labels, counts)}
+
+    def location(self, message):
+        """(conversation filename, row in its table, user, local time) of a message id"""
+        return (self.conversations[self.message_conversations[message]], int(self.message_rows[message]),
+                self.users[self.message_users[message]], stats.format_timestamp(self.message_times[message]))
+
+def show_messages(index, messages):
+    """Prints the messages, texts come from the parse cache"""
+    tables = {}
+    for message in messages:
+        filename, row, user, timestamp = index.location(message)
+        if filename not in tables:
+            tables[filename] = stats.load_table_cached(filename)
+        print(f'{timestamp} {user}: {tables[filename].texts[row]}')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Full-text search over facebook message exports')
+    parser.add_argument('--index', default=index_dir, help='Folder of the index')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build_parser = commands.add_parser('build', help='Index every conversation in the paths')
+    build_parser.add_argument('paths', nargs='+', help='Conversation files, directories or globs')
+    build_parser.add_argument('--language', choices=stats.export_languages, default=stats.export_language,
+                              help='Language the exports were downloaded in, decides how timestamps are read')
+    query_parser = commands.add_parser('query', help='Count the messages matching all parts')
+    query_parser.add_argument('parts', nargs='+', help='word, "a phrase" or prefix*')
+    query_parser.add_argument('--by', choices=('user',) + periods, default='user', help='How to count the hits')
+    query_parser.add_argument('--user', help='Only messages of this user')
+    query_parser.add_argument('--show', type=int, default=0, metavar='N', help='Print the N newest matching messages')
+    args = parser.parse_args()
+
+    stats.setup_logging()
+    if args.command == 'build':
+        stats.export_language = args.language
+        filenames = [filename for path in args.paths for filename in stats.find_conversations(path)]
+        print(f'Indexed {build_index(filenames, args.index)} messages from {len(filenames)} conversations')
+    else:
+        index = SearchIndex(args.index)
+        stats.export_language = index.meta['language']  # Texts for --show come from the same cache entries
+        messages = index.search(args.parts, args.user)
+        print(f'{len(messages)} messages')
+        for label, count in index.counts(messages, args.by).items():
+            print(f'{label}: {count}')
+        if args.show:
+            newest = messages[np.argsort(np.asarray(index.message_times[messages]), kind='stable')[::-1][:args.show]]
+            show_messages(index, newest)